@@ -0,0 +1,208 @@
+"""
+Benchmarks generate_responses.py on a small, randomly initialized GPT-2.
+
+Builds a GPT-2 model from a local config, a byte-level tokenizer and
+synthetic prompts whose token lengths follow the WritingPrompts prompt
+length distribution, so it runs on a CPU without the fine-tuned checkpoints
+or a network connection. The whole generation path (tokenization, batching,
+padding, the top-p loop, decoding and the CSV write) is timed and reported
+as JSON.
+
+Options that are not listed below are passed on to generate_responses.py,
+e.g. `--decoder fused --max-batch-tokens 2048`.
+"""
+# Standard imports
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+import time
+
+# Third-party imports
+import numpy as np
+import torch
+import transformers
+from transformers import GPT2Config, GPT2LMHeadModel
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+# Local imports
+import generate_responses
+
+
+# WritingPrompts test prompts are about 30 GPT-2 tokens long with a long right tail
+PROMPT_LENGTH_MEDIAN = 30
+PROMPT_LENGTH_SIGMA = 0.45
+PROMPT_LENGTH_RANGE = (4, 128)
+
+
+def build_model(model_dir, args):
+    """Save a randomly initialized GPT-2 and a byte-level tokenizer (257 tokens) to `model_dir`"""
+    # One token per byte plus <|endoftext|>, and no merges
+    byte_encoder = bytes_to_unicode()
+    vocab = {byte_encoder[i]: i for i in range(256)}
+    vocab["<|endoftext|>"] = 256
+    with open(os.path.join(model_dir, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(model_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+    torch.manual_seed(args.seed)
+    config = GPT2Config(vocab_size=len(vocab), n_positions=1024, n_ctx=1024, n_embd=args.n_embd,
+        n_layer=args.n_layer, n_head=args.n_head, bos_token_id=256, eos_token_id=256)
+    GPT2LMHeadModel(config).save_pretrained(model_dir)
+
+
+def write_prompts(prompt_path, num_prompts, seed):
+    """
+    Write synthetic prompts, one per line.
+
+    With the byte-level tokenizer every character is one token, so a prompt
+    of n characters has the token length of an n-token WritingPrompts prompt.
+    """
+    rng = np.random.RandomState(seed)
+    lengths = rng.lognormal(np.log(PROMPT_LENGTH_MEDIAN), PROMPT_LENGTH_SIGMA, num_prompts)
+    lengths = np.clip(lengths.round().astype(int), *PROMPT_LENGTH_RANGE)
+    chars = string.ascii_lowercase + " " * 5
+    letters = random.Random(seed)
+    with open(prompt_path, "w") as f:
+        for length in lengths:
+            f.write("".join(letters.choice(chars) for _ in range(length)).strip() or "a")
+            f.write("\n")
+    return lengths
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished child processes (shard workers)"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return max(own, children) / scale
+
+
+def count_generated_tokens(ids, offsets, eos_token_id):
+    """
+    Generated tokens over all rows, each counted up to and including its first end-of-text.
+
+    The `generate` decoder pads finished rows with end-of-text tokens and the
+    fused decoder stops at the first one, so this counts both the same way.
+    """
+    ids = np.asarray(ids)
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    eos_positions = np.nonzero(ids == eos_token_id)[0]
+    first_eos = offsets[1:].copy()
+    np.minimum.at(first_eos, rows[eos_positions], eos_positions)
+    return int(np.minimum(first_eos + 1, offsets[1:]).sum() - offsets[:-1].sum())
+
+
+def run_benchmark(args, generate_argv):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = os.path.join(tmp_dir, "model")
+        os.makedirs(model_dir)
+        build_model(model_dir, args)
+        prompt_path = os.path.join(tmp_dir, "prompts.txt")
+        write_prompts(prompt_path, args.num_prompts, args.seed)
+
+        gen_args = generate_responses.parse_args([
+            "--prompt-path", prompt_path,
+            "--model-name-or-path", model_dir,
+            "--output-path", os.path.join(tmp_dir, "output.csv"),
+            "--token-output", os.path.join(tmp_dir, "tokens"),
+            "--length", str(args.length),
+            "--bsz", str(args.bsz),
+            "--top-p", *[str(p) for p in args.top_p],
+            "--seed", str(args.seed),
+            "--display-progress", str(10**9),
+        ] + ([] if args.cuda else ["--no-cuda"]) + generate_argv)
+        if args.threads:
+            torch.set_num_threads(args.threads)
+
+        # Time tokenization and length bucketing on their own
+        tokenizer = generate_responses.load_tokenizer(gen_args)
+        prompts = list(generate_responses.read_prompts(prompt_path))
+        start_time = time.time()
+        encoded_prompts = generate_responses.encode_prompts(tokenizer, prompts)
+        tokenize_seconds = time.time() - start_time
+        lengths = [len(ids) for ids in encoded_prompts]
+        start_time = time.time()
+        batches = generate_responses.schedule_batches(lengths, gen_args.bsz, gen_args.max_batch_tokens)
+        for batch in batches:
+            generate_responses.pad_batch([encoded_prompts[idx] for idx in batch], tokenizer.pad_token_id)
+        schedule_seconds = time.time() - start_time
+
+        # The full run, from the prompt file to the CSV
+        start_time = time.time()
+        generate_responses.main(gen_args)
+        generate_seconds = time.time() - start_time
+
+        ids, offsets, _ = generate_responses.read_token_output(gen_args.token_output)
+        generated_tokens = count_generated_tokens(ids, offsets, tokenizer.eos_token_id)
+        num_rows = len(offsets) - 1
+        del ids
+
+    file_order = [list(range(i, min(i + gen_args.bsz, len(lengths)))) for i in range(0, len(lengths), gen_args.bsz)]
+    return {
+        "num_prompts": args.num_prompts,
+        "num_rows": num_rows,
+        "generated_tokens": generated_tokens,
+        "seconds": round(generate_seconds, 3),
+        "prompts_per_sec": round(args.num_prompts / generate_seconds, 3),
+        "tokens_per_sec": round(generated_tokens / generate_seconds, 3),
+        "tokenize_seconds": round(tokenize_seconds, 4),
+        "schedule_seconds": round(schedule_seconds, 4),
+        "mean_prompt_tokens": round(float(np.mean(lengths)), 2),
+        "padding_waste": round(generate_responses.padding_waste(lengths, batches), 4),
+        "padding_waste_file_order": round(generate_responses.padding_waste(lengths, file_order), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "config": {
+            "n_layer": args.n_layer,
+            "n_embd": args.n_embd,
+            "n_head": args.n_head,
+            "length": args.length,
+            "bsz": args.bsz,
+            "top_p": args.top_p,
+            "decoder": gen_args.decoder,
+            "generate_args": generate_argv,
+            "device": str(gen_args.device),
+            "threads": torch.get_num_threads(),
+        },
+        "versions": {"torch": torch.__version__, "transformers": transformers.__version__},
+    }
+
+
+def parse_args():
+    """Process commandline arguments. Unknown options are passed on to generate_responses.py."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-prompts", type=int, default=200, help="Number of synthetic prompts")
+    parser.add_argument("--length", type=int, default=50, help="Maximum response length in tokens")
+    parser.add_argument("--bsz", type=int, default=8, help="Batch size")
+    parser.add_argument("--top-p", type=float, nargs="+", default=[0.0, 0.7, 0.95], help="Top-p values to decode")
+    parser.add_argument("--n-layer", type=int, default=2, help="Number of layers of the random model")
+    parser.add_argument("--n-embd", type=int, default=128, help="Hidden size of the random model")
+    parser.add_argument("--n-head", type=int, default=4, help="Number of attention heads of the random model")
+    parser.add_argument("--threads", type=int, default=None, help="Torch CPU threads (default: torch's choice)")
+    parser.add_argument("--cuda", action="store_true", help="Run on the GPU if there is one (default: CPU)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the model weights, prompts and sampling")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="Show the generation logs")
+    return parser.parse_known_args()
+
+
+if __name__ == "__main__":
+    args, generate_argv = parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    report = run_benchmark(args, generate_argv)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,14 +1,19 @@
 """
 Automatic evaluation of generated narratives. 
 
-Uses distinct-1,2 and sentBERT for evaluating diversity.
+Uses distinct-n (n=1,2 by default, up to 4), n-gram entropy, self-BLEU and sentBERT for evaluating diversity.
 
 Author: Alexandra DeLucia
 """
 # Standard imports
 import os
+import json
+import hashlib
 import argparse
 import logging
+import itertools
+import collections
+import multiprocessing
 import regex
 import pandas as pd
 from csv import QUOTE_ALL
@@ -16,14 +21,20 @@ from csv import QUOTE_ALL
 # Third-party
 from sentence_transformers import SentenceTransformer
 import torch
-from scipy.spatial.distance import pdist
+from scipy.stats import norm
 import numpy as np
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
+# Version of each metric's implementation, including the response cleaning.
+# Increase one to recompute its results in a --results-store.
+METRIC_VERSIONS = {"dist-n": 1, "entropy": 1, "self-BLEU": 1, "sentBERT": 1}
+
 # Global SentBERT
-sentbert_model = None 
+SENTBERT_MODEL_NAME = "bert-large-nli-stsb-mean-tokens"
+sentence_encoder = None
+embedding_cache = None
 
 
 def parse_args():
@@ -35,76 +46,853 @@ def parse_args():
     parser.add_argument("--antilm", action="store_true")
 
     parser.add_argument("--metrics", nargs="+", default=set(["dist-n", "sentBERT"]), 
-        choices=["dist-n", "sentBERT"], help="Evaluation metrics")
-
-    parser.add_argument("--cpu", help="Use CPU even if GPU is available")
+        choices=["dist-n", "entropy", "self-BLEU", "sentBERT"], help="Evaluation metrics")
+    parser.add_argument("--dist-n", type=int, nargs="+", default=[1, 2], choices=[1, 2, 3, 4],
+        help="n-gram orders for distinct-n and entropy, written as columns dist1, dist2, ... and entropy1, entropy2, ...")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+        help="Number of rows read from a file at a time, and of responses added to a group's metrics at a time")
+    parser.add_argument("--num-workers", type=int, default=1,
+        help="Processes computing distinct-n, entropy and self-BLEU for shares of the groups of all the input files")
+
+    parser.add_argument("--self-bleu-sample", type=int, default=None,
+        help="Compute self-BLEU over this many random responses per group instead of all of them")
+    parser.add_argument("--sentbert-sample", type=int, default=None,
+        help="Estimate sentBERT from this many random responses per group, with 95%% bounds in the "
+             "sentBERT_low and sentBERT_high columns")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for --sentbert-sample and --self-bleu-sample")
+    parser.add_argument("--embedding-cache", type=str, default=None,
+        help="Directory of stored sentBERT embeddings. Only responses not in it are encoded, and they are added.")
+    parser.add_argument("--results-store", type=str, default=None,
+        help="JSONL file of computed metrics, keyed by input file content, group, metric and version. "
+             "Only results missing from it are computed, and the output CSV is rebuilt from it.")
+    parser.add_argument("--cpu", action="store_true", help="Use CPU even if GPU is available")
+    parser.add_argument("--encode-memory-mb", type=int, default=1024,
+        help="Activation memory budget of one sentBERT batch. Batch sizes are set from it and the padded batch length.")
+    parser.add_argument("--encode-workers", type=int, default=1,
+        help="Processes encoding sentBERT batches on the CPU, each with its own copy of the model")
+    parser.add_argument("--encode-threads", type=int, default=None,
+        help="Torch threads per encoding process (default: the CPU count divided by --encode-workers)")
     parser.add_argument("--debug", action="store_true")
     return parser.parse_args()
 
 
-def sentBERT(responses):
+def _normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def mean_pairwise_cosine_distance(embeddings):
     """
-    Compute average pairwise cosine distance between BERT representations
+    Mean cosine distance over all pairs of rows, without the n(n-1)/2 distances.
 
-    Note: Diversity paper uses cosine similarity and then negates it, here
-    we just use cosine distance
+    Equal to np.average(pdist(embeddings, metric="cosine")) up to rounding.
+    With unit rows u_i, the sum of u_i . u_j over pairs i != j is
+    |sum u_i|^2 - sum |u_i|^2, so memory is O(n d) and the sum is one BLAS
+    matrix-vector product.
     """
-    embeddings = sentbert_model.encode(responses)
-    distances = pdist(embeddings, metric="cosine")
-    return np.average(distances)
+    pairs = PairwiseCosine()
+    pairs.update(embeddings)
+    return pairs.distance()
 
 
-def distinct_1(lines):
-    '''
-    Computes the number of distinct words divided by the total number of words.
-    Input:
-    lines: List of strings.
+class PairwiseCosine:
+    """
+    Mean pairwise cosine distance of embeddings added a batch at a time.
 
-    Written by Joao Sedoc
-    '''
-    words = ' '.join(lines).split(' ')
-    num_distinct_words = len(set(words))
-    return float(num_distinct_words) / len(words)
+    Keeps only the sum of the normalized embeddings, the sum of their squared
+    norms and their count (see `mean_pairwise_cosine_distance`).
+    """
+    def __init__(self):
+        self.total = 0.0
+        self.sum_squares = 0.0
+        self.count = 0
 
+    def update(self, embeddings):
+        unit = _normalize_rows(embeddings)
+        self.total = self.total + np.ones(len(unit)) @ unit
+        self.sum_squares += np.einsum("ij,ij->", unit, unit)
+        self.count += len(unit)
 
-def distinct_2(lines):
-    '''Computes the number of distinct bigrams divided by the total number of words.
+    def distance(self):
+        pair_similarity = (self.total @ self.total - self.sum_squares) / (self.count * (self.count - 1))
+        return 1.0 - pair_similarity
 
-    Input:
-    lines: List of strings.
 
-    Written by Joao Sedoc
-    '''
-    all_bigrams = []
-    num_words = 0
+def sampled_pairwise_cosine_distance(embeddings, confidence=0.95):
+    """
+    Mean pairwise cosine distance of a random sample of rows, with a confidence interval.
 
-    for line in lines:
-        line_list = line.split(' ')
-        num_words += len(line_list)
-        bigrams = zip(line_list, line_list[1:])
-        all_bigrams.extend(list(bigrams))
+    The sample mean over pairs is a U-statistic. Its standard error is
+    2 * std(h_i) / sqrt(m), where h_i is the mean distance from row i to the
+    other m - 1 rows. Returns (estimate, lower bound, upper bound).
+    """
+    unit = _normalize_rows(embeddings)
+    m = len(unit)
+    total = np.ones(m) @ unit
+    row_distance = 1.0 - (unit @ total - np.einsum("ij,ij->i", unit, unit)) / (m - 1)
+    estimate = row_distance.mean()
+    margin = norm.ppf(0.5 + confidence / 2) * 2 * row_distance.std(ddof=1) / np.sqrt(m)
+    return estimate, estimate - margin, estimate + margin
+
+
+def embed(responses):
+    """sentBERT embeddings of `responses`, through the embedding cache if there is one"""
+    if embedding_cache is not None:
+        return embedding_cache.encode(responses, sentence_encoder.encode)
+    return sentence_encoder.encode(responses)
+
+
+def load_sentence_encoder(args):
+    """Load the sentBERT model and the embedding cache, once"""
+    global sentence_encoder, embedding_cache
+    if sentence_encoder is not None:
+        return
+    if args.cpu or not torch.cuda.is_available():
+        device = "cpu"
+    else:
+        device = "cuda"
+        # Claim GPU
+        torch.ones(1).to(device)
+    # Instantiate model
+    sentence_encoder = SentenceEncoder(SENTBERT_MODEL_NAME, device, args.encode_memory_mb,
+        args.encode_workers, args.encode_threads)
+    if args.embedding_cache:
+        embedding_cache = EmbeddingCache(args.embedding_cache, SENTBERT_MODEL_NAME)
+
+
+# Encoding worker state, set by _init_encode_worker in each worker process
+_worker_model = None
+
+
+def _pin_threads(threads, cpus=None):
+    """Limit torch to `threads` threads and, if given, this process to the CPU ids `cpus`"""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+
+
+def _init_encode_worker(model_name, threads, worker_counter):
+    global _worker_model
+    # Give each worker its own block of `threads` CPUs
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    block = cpus[worker_id * threads:(worker_id + 1) * threads]
+    _pin_threads(threads, block if len(block) == threads else None)
+    _worker_model = SentenceTransformer(model_name).to("cpu")
+
+
+def _encode_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts))
+
+
+def _model_dimensions(model=None):
+    """(hidden size, maximum sequence length) of the SentenceTransformer, with BERT defaults"""
+    model = model if model is not None else _worker_model
+    hidden_size = model.get_sentence_embedding_dimension() if hasattr(model, "get_sentence_embedding_dimension") else None
+    max_length = model.get_max_seq_length() if hasattr(model, "get_max_seq_length") else None
+    return hidden_size or 1024, max_length or 512
+
+
+class SentenceEncoder:
+    """
+    Encodes sentences in length-sorted batches whose size is set from a memory budget.
+
+    Sentences are sorted by estimated token length, longest first, so each
+    batch pads to nearly its own length. A batch takes as many sentences as
+    fit in `memory_mb` of activations at the length of its longest sentence.
+    With `workers` > 1 the batches are encoded on the CPU by a pool of
+    processes, each with its own model and `threads` pinned torch threads.
+    Embeddings are returned in the order of the input sentences.
+    """
+    def __init__(self, model_name, device, memory_mb=1024, workers=1, threads=None):
+        self.pool = None
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        if workers > 1 and device == "cpu":
+            # Spawned workers do not inherit this process's torch thread pools
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(workers, initializer=_init_encode_worker,
+                initargs=(model_name, threads, context.Value("i", 0)))
+            hidden_size, self.max_length = self.pool.apply(_model_dimensions)
+        else:
+            if device == "cpu":
+                _pin_threads(threads)
+            self.model = SentenceTransformer(model_name).to(device)
+            hidden_size, self.max_length = _model_dimensions(self.model)
+        # Under no_grad a BERT layer holds about 12 hidden-size activations per token
+        # (the query/key/value, attention output, residual and 4x feed-forward) plus a
+        # row of attention scores per head, in float32
+        bytes_per_token = 4 * (12 * hidden_size + (hidden_size // 64) * self.max_length)
+        self.batch_tokens = max(self.max_length, memory_mb * 2**20 // bytes_per_token)
+        logging.info(f"Encoding on {device} with {workers if self.pool else 1} process(es) of {threads} thread(s), "
+                     f"up to {self.batch_tokens} padded tokens per batch")
+
+    def estimate_length(self, text):
+        # About 4 WordPieces for every 3 words, plus [CLS] and [SEP]
+        return min(self.max_length, len(text.split()) * 4 // 3 + 2)
+
+    def batches(self, texts):
+        """Lists of indices into `texts`, longest first, each within the token budget"""
+        lengths = [self.estimate_length(text) for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: -lengths[i])
+        batches = []
+        for idx in order:
+            # The first sentence of a batch is its longest
+            if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= self.batch_tokens:
+                batches[-1].append(idx)
+            else:
+                batches.append([idx])
+        return batches
+
+    def encode(self, texts):
+        batches = self.batches(texts)
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+        if self.pool is not None:
+            outputs = self.pool.imap(_encode_batch, batch_texts)
+        else:
+            outputs = (self.model.encode(batch, batch_size=len(batch)) for batch in batch_texts)
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        for batch, output in zip(batches, outputs):
+            output = np.asarray(output)
+            if not embeddings.size:
+                embeddings = np.empty((len(texts), output.shape[1]), dtype=output.dtype)
+            embeddings[batch] = output
+        return embeddings
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class EmbeddingCache:
+    """
+    Persistent sentence embeddings, keyed by a hash of the model name and the text.
+
+    Stored in `cache_dir` as three files per model: `<model>.emb` holds the
+    float32 embeddings one row after another and is read through a memory
+    map, `<model>.keys` holds the 16-byte key of each row, and `<model>.json`
+    holds the embedding size. Both data files are append-only, and the
+    meta file is written after the first rows. If a run is killed between
+    the appends, the unmatched rows are dropped on load.
+    """
+    KEY_BYTES = 16
+
+    def __init__(self, cache_dir, model_name):
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.join(cache_dir, model_name.replace("/", "_"))
+        self.model_name = model_name
+        self.emb_path = f"{prefix}.emb"
+        self.keys_path = f"{prefix}.keys"
+        self.meta_path = f"{prefix}.json"
+        self.dim = None
+        self.index = {}
+        self.num_rows = 0
+        self.embeddings = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+            self._load()
+        else:
+            # Rows from a first run killed before it wrote the meta file
+            for path in (self.emb_path, self.keys_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def key(self, text):
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode("utf-8"), digest_size=self.KEY_BYTES).digest()
+
+    def _load(self):
+        num_keys = os.path.getsize(self.keys_path) // self.KEY_BYTES if os.path.exists(self.keys_path) else 0
+        num_rows = os.path.getsize(self.emb_path) // (4 * self.dim) if os.path.exists(self.emb_path) else 0
+        count = min(num_keys, num_rows)
+        # Drop rows from an interrupted append
+        for path, row_bytes in ((self.keys_path, self.KEY_BYTES), (self.emb_path, 4 * self.dim)):
+            if os.path.exists(path) and os.path.getsize(path) != count * row_bytes:
+                with open(path, "r+b") as f:
+                    f.truncate(count * row_bytes)
+        keys = b""
+        if count:
+            with open(self.keys_path, "rb") as f:
+                keys = f.read()
+        self.index = {keys[i * self.KEY_BYTES:(i + 1) * self.KEY_BYTES]: i for i in range(count)}
+        self.num_rows = count
+        self.embeddings = np.memmap(self.emb_path, dtype=np.float32, mode="r", shape=(count, self.dim)) if count else None
+
+    def _append(self, keys, embeddings):
+        with open(self.emb_path, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.keys_path, "ab") as f:
+            f.write(b"".join(keys))
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self.meta_path, "w") as f:
+                json.dump({"model": self.model_name, "dim": self.dim}, f)
+        for row, key in enumerate(keys, start=self.num_rows):
+            self.index[key] = row
+        self.num_rows += len(keys)
+        self.embeddings = np.memmap(self.emb_path, dtype=np.float32, mode="r", shape=(self.num_rows, self.dim))
+
+    def encode(self, texts, encode_fn):
+        """
+        Embeddings of `texts`, running `encode_fn` only on the texts not stored yet
+        """
+        keys = [self.key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        logging.info(f"\t{len(texts) - len(missing)} of {len(texts)} embeddings cached, encoding {len(missing)}")
+        if missing:
+            self._append(list(missing), np.asarray(encode_fn(list(missing.values())), dtype=np.float32))
+        return self.embeddings[[self.index[key] for key in keys]]
+
+
+class _NgramTable:
+    """
+    Set of integer n-gram keys, each with a dense id in order of first appearance.
 
-    return len(set(all_bigrams)) / float(num_words)
+    Keys are held in a sorted array, so the state is 16 bytes per distinct n-gram.
+    """
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys):
+        """Return the id of every key in `keys`, adding the ones not seen before"""
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        pos = np.searchsorted(self.keys, unique_keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == unique_keys[found]
+        unique_ids = np.empty(len(unique_keys), dtype=np.int64)
+        unique_ids[found] = self.ids[pos[found]]
+        new = ~found
+        unique_ids[new] = len(self.keys) + np.arange(new.sum())
+        self.keys = np.insert(self.keys, pos[new], unique_keys[new])
+        self.ids = np.insert(self.ids, pos[new], unique_ids[new])
+        return unique_ids[inverse].reshape(-1)
+
+
+class DistinctNgrams:
+    """
+    Streaming distinct-n for every n from 1 to `max_n`.
+
+    distinct-n is the number of distinct n-grams (not crossing lines) over
+    all lines, divided by the total number of words. Words are split on
+    single spaces.
+
+    Lines can be added in chunks with `update`. Words are mapped to integer
+    ids, and each n-gram to the id of its (n-1)-gram prefix combined with its
+    last word, so the n-grams of a chunk are built with array operations and
+    only the sets of distinct n-grams are kept between chunks. With `counts`,
+    the number of occurrences of each distinct n-gram is kept as well, for
+    `entropy`.
+    """
+    def __init__(self, max_n=2, counts=False):
+        self.max_n = max_n
+        self.vocab = {}
+        self.num_words = 0
+        # Tables for n = 2, ..., max_n. The distinct words are the vocabulary.
+        self.tables = [_NgramTable() for _ in range(max_n - 1)]
+        # Occurrences of each n-gram id for n = 1, ..., max_n
+        self.counts = [np.zeros(0, dtype=np.int64) for _ in range(max_n)] if counts else None
+
+    def update(self, lines):
+        """
+        Add `lines`. Returns, for n = 1, ..., max_n, the (line index, n-gram id) of each n-gram in them.
+        """
+        words = []
+        lengths = []
+        for line in lines:
+            line_words = line.split(" ")
+            words.extend(line_words)
+            lengths.append(len(line_words))
+        if not words:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))] * self.max_n
+        self.num_words += len(words)
+
+        # Map words to global ids, looking up each distinct word of the chunk once.
+        # pd.factorize compares strings only up to a NUL, so chunks with one are looked up word by word.
+        if any("\x00" in line for line in lines):
+            word_ids = np.array([self.vocab.setdefault(word, len(self.vocab)) for word in words], dtype=np.int64)
+        else:
+            codes, chunk_vocab = pd.factorize(np.array(words, dtype=object))
+            word_ids = np.array([self.vocab.setdefault(word, len(self.vocab)) for word in chunk_vocab],
+                                dtype=np.int64)[codes]
+
+        # Number of words from each position to the end of its line
+        ends = np.repeat(np.cumsum(lengths), lengths)
+        remaining = ends - np.arange(len(words))
+
+        line_index = np.repeat(np.arange(len(lengths)), lengths)
+        ngrams = [(line_index, word_ids)]
+        prefix_ids = word_ids
+        for n, table in enumerate(self.tables, start=2):
+            starts = np.nonzero(remaining >= n)[0]
+            keys = (prefix_ids[starts] << 32) | word_ids[starts + n - 1]
+            prefix_ids = np.full(len(words), -1, dtype=np.int64)
+            prefix_ids[starts] = table.add(keys)
+            ngrams.append((line_index[starts], prefix_ids[starts]))
+
+        if self.counts is not None:
+            for i, (_, ids) in enumerate(ngrams):
+                counts = np.bincount(ids, minlength=self.num_distinct(i + 1))
+                counts[:len(self.counts[i])] += self.counts[i]
+                self.counts[i] = counts
+        return ngrams
+
+    def num_distinct(self, n):
+        return len(self.vocab) if n == 1 else len(self.tables[n - 2])
+
+    def distinct(self, n):
+        return self.num_distinct(n) / float(self.num_words)
+
+    def entropy(self, n):
+        """Entropy, in nats, of the frequencies of the n-grams. Needs `counts`."""
+        counts = self.counts[n - 1]
+        probabilities = counts[counts > 0] / float(counts.sum())
+        return float(-(probabilities * np.log(probabilities)).sum())
+
+
+def self_bleu(lines, max_n=4):
+    """
+    Self-BLEU: mean BLEU-`max_n` of each line with all the other lines as its references.
+
+    Like Texygen's self-BLEU with nltk: uniform weights, the closest
+    reference length for the brevity penalty, and smoothing method 1 (0.1
+    for n-gram orders without a match). Instead of comparing every pair of
+    lines, one table holds the largest and second largest count of each
+    n-gram over the lines and the line with the largest. A line's n-gram
+    count is clipped to the largest count in the other lines: the largest
+    count, or the second largest if the largest is in this line. The cost is
+    linear in the number of n-grams.
+    """
+    if len(lines) < 2:
+        return float("nan")
+    counter = DistinctNgrams(max_n)
+    ngrams = counter.update(lines)
+    lengths = np.bincount(ngrams[0][0], minlength=len(lines))
+
+    log_precision = np.zeros(len(lines))
+    for n, (line_index, ids) in enumerate(ngrams, start=1):
+        # Count of every n-gram in every line
+        num_ids = max(counter.num_distinct(n), 1)
+        keys, counts = np.unique(line_index * num_ids + ids, return_counts=True)
+        key_lines, key_ids = np.divmod(keys, num_ids)
+
+        # Largest and second largest count of each n-gram, and the line with the largest
+        order = np.lexsort((-counts, key_ids))
+        sorted_ids, sorted_counts, sorted_lines = key_ids[order], counts[order], key_lines[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        second = np.zeros(len(order), dtype=bool)
+        second[1:] = first[:-1] & ~first[1:]
+        largest = np.zeros(num_ids, dtype=np.int64)
+        largest[sorted_ids[first]] = sorted_counts[first]
+        largest_line = np.full(num_ids, -1, dtype=np.int64)
+        largest_line[sorted_ids[first]] = sorted_lines[first]
+        second_largest = np.zeros(num_ids, dtype=np.int64)
+        second_largest[sorted_ids[second]] = sorted_counts[second]
+
+        reference_counts = np.where(largest_line[key_ids] == key_lines, second_largest[key_ids], largest[key_ids])
+        matches = np.bincount(key_lines, np.minimum(counts, reference_counts), minlength=len(lines))
+        if n == 1:
+            unigram_matches = matches
+        totals = np.maximum(lengths - n + 1, 1)
+        log_precision += np.log(np.where(matches > 0, matches, 0.1) / totals) / max_n
+
+    # Closest length among the other lines, the shorter one on a tie
+    unique_lengths, length_counts = np.unique(lengths, return_counts=True)
+    position = np.searchsorted(unique_lengths, lengths)
+    closest = np.zeros(len(lines))
+    closest_distance = np.full(len(lines), np.inf)
+    for offset in (-1, 0, 1):
+        candidate = np.clip(position + offset, 0, len(unique_lengths) - 1)
+        valid = (position + offset >= 0) & (position + offset < len(unique_lengths))
+        valid &= (unique_lengths[candidate] != lengths) | (length_counts[candidate] > 1)
+        distance = np.where(valid, np.abs(unique_lengths[candidate] - lengths), np.inf)
+        better = distance < closest_distance
+        closest[better] = unique_lengths[candidate][better]
+        closest_distance[better] = distance[better]
+
+    with np.errstate(divide="ignore"):
+        brevity_penalty = np.where(lengths > closest, 1.0, np.exp(1 - closest / np.maximum(lengths, 1)))
+    scores = np.where(unigram_matches > 0, brevity_penalty * np.exp(log_precision), 0.0)
+    return float(scores.mean())
+
+
+SPECIAL_TOKENS = regex.compile(r"<\|endoftext\|>|<newline>|\[RESPONSE\]")
+PUNCTUATION = regex.compile(r"\p{P}")
+# Whitespace runs other than a single space, the only ones that change when collapsed
+EXCESS_SPACE = regex.compile(r" \s+|[^\S ]\s*")
+# Joins the responses of a batch. It is neither whitespace nor punctuation
+# and ends a word for lowercasing, like the end of a string does.
+BATCH_SEPARATOR = "\x00"
 
 
 def clean_response(response):
     """
-    Remove special tokens from the response
+    Remove special tokens, lowercase, split off punctuation and collapse whitespace
+
+    Same output as the original version (checked in test_evaluation.py), with
+    precompiled patterns that only match text that changes. Special tokens
+    are removed before lowercasing because they are case sensitive and
+    lowercasing depends on the neighbouring characters.
     """
-    og_response = response
     # Remove extra characters
     response = response.strip()
     # Remove special tokens
-    response = regex.sub("<\|endoftext\|>|<newline>|\[RESPONSE\]", "", response)
+    if "<" in response or "[" in response:
+        response = SPECIAL_TOKENS.sub("", response)
     # Lowercase
     response = response.lower()
-    # Add spaces in front of punctuation
-    logging.debug(regex.findall("(\p{P})", response))
-    response = regex.sub("(\p{P})", " \\1", response)
-    # Remove excess spacing
-    response = regex.sub("\s+", " ", response)
-    logging.debug(f"OG: {og_response}\nNew: {response}")
-    return response
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(PUNCTUATION.findall(response))
+    # Add spaces in front of punctuation, then remove excess spacing
+    return EXCESS_SPACE.sub(" ", PUNCTUATION.sub(" \\g<0>", response))
+
+
+def clean_responses(responses):
+    """
+    Clean a list of responses, running each pattern once over the whole list
+    """
+    if not responses:
+        return []
+    text = BATCH_SEPARATOR.join(response.strip() for response in responses)
+    if text.count(BATCH_SEPARATOR) != len(responses) - 1 or logging.getLogger().isEnabledFor(logging.DEBUG):
+        # A response contains the separator, or each response is logged
+        return [clean_response(response) for response in responses]
+    if "<" in text or "[" in text:
+        text = SPECIAL_TOKENS.sub("", text)
+    text = EXCESS_SPACE.sub(" ", PUNCTUATION.sub(" \\g<0>", text.lower()))
+    return text.split(BATCH_SEPARATOR)
+
+
+class ResultsStore:
+    """
+    Evaluation results, keyed by (input file hash, group, metric, version).
+
+    Kept in an append-only JSONL file with one result per line; a later line
+    for the same key replaces an earlier one. A result whose version differs
+    from the current one is not found, so it is recomputed. Without a path
+    the results are kept in memory only.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    self.results[(result["file_hash"], result["group"], result["metric"], result["version"])] = result["value"]
+            logging.info(f"Loaded {len(self.results)} results from {path}")
+
+    def get(self, file_hash, group, metric, version):
+        return self.results.get((file_hash, group, metric, version))
+
+    def put(self, file_hash, group, metric, version, value):
+        self.results[(file_hash, group, metric, version)] = value
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"file_hash": file_hash, "group": group, "metric": metric,
+                                    "version": version, "value": value}) + "\n")
+
+    def computed(self, file_hash, metrics):
+        """(group, name) of each result of `metrics`, as (name, version, columns), stored for a file"""
+        versions = {name: version for name, version, _ in metrics}
+        return {(group, metric) for result_hash, group, metric, version in self.results
+                if result_hash == file_hash and versions.get(metric) == version}
+
+
+def hash_file(path):
+    """Hash of the file's content"""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def group_key(mode, row):
+    """Store key of a group, from how the responses were grouped and its [model size, dataset size, top-p, lambda]"""
+    return mode + ":" + "_".join(str(value) for value in row)
+
+
+def requested_metrics(args):
+    """
+    The (name, version, columns) of each metric result to compute.
+
+    The name includes any option that changes the value; each dist-n order
+    is its own result so adding an order only computes that order.
+    """
+    metrics = []
+    if "dist-n" in args.metrics:
+        for n in args.dist_n:
+            metrics.append((f"dist{n}", METRIC_VERSIONS["dist-n"], [f"dist{n}"]))
+    if "entropy" in args.metrics:
+        for n in args.dist_n:
+            metrics.append((f"entropy{n}", METRIC_VERSIONS["entropy"], [f"entropy{n}"]))
+    if "self-BLEU" in args.metrics:
+        if args.self_bleu_sample:
+            metrics.append((f"self-BLEU-sample{args.self_bleu_sample}-seed{args.seed}", METRIC_VERSIONS["self-BLEU"],
+                            ["self-BLEU"]))
+        else:
+            metrics.append(("self-BLEU", METRIC_VERSIONS["self-BLEU"], ["self-BLEU"]))
+    if "sentBERT" in args.metrics:
+        version = f"{METRIC_VERSIONS['sentBERT']}-{SENTBERT_MODEL_NAME}"
+        if args.sentbert_sample:
+            metrics.append((f"sentBERT-sample{args.sentbert_sample}-seed{args.seed}", version,
+                            ["sentBERT", "sentBERT_low", "sentBERT_high"]))
+        else:
+            metrics.append(("sentBERT", version, ["sentBERT"]))
+    return metrics
+
+
+def read_chunks(input_file, args):
+    """
+    Read an output file `args.chunk_size` rows at a time.
+
+    Yields (ids, responses) lists. Baseline files have one response per line
+    and no ids.
+    """
+    if args.baseline:
+        with open(input_file) as f:
+            while True:
+                lines = list(itertools.islice(f, args.chunk_size))
+                if not lines:
+                    return
+                yield None, lines
+    else:
+        for chunk in pd.read_csv(input_file, index_col=0, quoting=QUOTE_ALL, dtype=str, chunksize=args.chunk_size):
+            yield chunk.index.tolist(), chunk.response.tolist()
+
+
+def file_info(input_file, args):
+    """
+    [model size, dataset size] of an output file, from its name, and the
+    (top-p, lambda) of all its responses for a baseline file, or None.
+    """
+    if args.baseline:
+        # Get model and training info from filename
+        # Example format: /path/to/baseline_dummy_med_0.5.txt
+        dataset_size, top_p = input_file.split("/")[-1][:-4].split("_")[-2:]
+        if top_p == "argmax":
+            top_p = 0.0
+        model = "fusion"
+        model_size = "NA"
+        return [model_size, dataset_size], (top_p, 0.0)
+    # Get model and training info from filename
+    # Example format: /path/to/gpt2_med_med.csv
+    model, model_size, dataset_size = input_file.split("/")[-1].split(".")[0].split("_")
+    return [model_size, dataset_size], None
+
+
+def read_groups(input_file, args, shard=0, num_shards=1):
+    """
+    Stream the cleaned responses of one output file by (top-p, lambda) group.
+
+    Yields ((top-p, lambda), cleaned responses) a chunk at a time. Groups are
+    numbered in order of first appearance, which is the same in every process
+    reading the file, and only those whose number is `shard` modulo
+    `num_shards` are cleaned and yielded.
+    """
+    _, baseline_key = file_info(input_file, args)
+    numbers = {}
+    for ids, responses in read_chunks(input_file, args):
+        if ids is None:
+            groups = [(baseline_key, responses)]
+        else:
+            # ids are <prompt id>_<top-p>[_<lambda>]
+            parts = pd.Series(ids).str.split("_", expand=True)
+            lamb = parts[2] if args.antilm else pd.Series(0.0, index=parts.index)
+            groups = [(key, group.tolist()) for key, group in pd.Series(responses).groupby([parts[1], lamb], sort=False)]
+        for key, group in groups:
+            if numbers.setdefault(key, len(numbers)) % num_shards == shard:
+                yield key, clean_responses(group)
+
+
+class Reservoir:
+    """
+    Seeded uniform sample of `size` items from a stream, or all of them if `size` is None
+    """
+    def __init__(self, size=None, seed=0):
+        self.size = size
+        self.rng = np.random.RandomState(seed)
+        self.items = []
+        self.num_seen = 0
+
+    def add(self, items):
+        fill = len(items) if self.size is None else max(0, min(len(items), self.size - self.num_seen))
+        self.items.extend(items[:fill])
+        if fill < len(items):
+            # The i-th item replaces a random slot with probability size / (i + 1)
+            slots = self.rng.randint(0, self.num_seen + np.arange(fill, len(items)) + 1)
+            for item, slot in zip(items[fill:], slots):
+                if slot < self.size:
+                    self.items[slot] = item
+        self.num_seen += len(items)
+
+    def sampled(self):
+        return self.size is not None and self.num_seen > self.size
+
+
+class GroupAccumulator:
+    """
+    Metrics of one (top-p, lambda) group, computed from its responses a chunk at a time.
+
+    Cleaned responses are buffered until `chunk_size` are waiting. Each chunk
+    goes through one n-gram counting pass for both `dist_orders` and
+    `entropy_orders`. With `sentbert`, the chunk is also encoded and added to
+    the pairwise cosine sums. With `sentbert_sample`, sentBERT instead keeps a
+    seeded reservoir sample of that many responses, which is encoded at the
+    end. Self-BLEU is computed at the end, over all responses or over a
+    reservoir sample of `self_bleu_sample` responses.
+    """
+    def __init__(self, dist_orders=(), entropy_orders=(), sentbert=False, self_bleu=False, chunk_size=1000,
+                 sentbert_sample=None, self_bleu_sample=None, seed=0):
+        self.dist_orders = dist_orders
+        self.entropy_orders = entropy_orders
+        orders = list(dist_orders) + list(entropy_orders)
+        self.counter = DistinctNgrams(max(orders), counts=bool(entropy_orders)) if orders else None
+        self.pairs = PairwiseCosine() if sentbert and not sentbert_sample else None
+        self.sentbert_sample = Reservoir(sentbert_sample, seed) if sentbert and sentbert_sample else None
+        self.self_bleu_sample = Reservoir(self_bleu_sample, seed) if self_bleu else None
+        self.chunk_size = chunk_size
+        self.buffer = []
+
+    def add(self, responses):
+        self.buffer.extend(responses)
+        if len(self.buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if self.counter is not None:
+            self.counter.update(self.buffer)
+        if self.pairs is not None and self.buffer:
+            self.pairs.update(embed(self.buffer))
+        for sample in (self.sentbert_sample, self.self_bleu_sample):
+            if sample is not None:
+                sample.add(self.buffer)
+        self.buffer = []
+
+    def results(self):
+        """{"dist1": distinct-1, ..., "entropy1": ..., "sentBERT": score, "self-BLEU": score} for the metrics computed"""
+        self._flush()
+        results = {}
+        if self.counter is not None:
+            results.update((f"dist{n}", self.counter.distinct(n)) for n in self.dist_orders)
+            results.update((f"entropy{n}", self.counter.entropy(n)) for n in self.entropy_orders)
+        if self.pairs is not None:
+            results["sentBERT"] = self.pairs.distance()
+        if self.sentbert_sample is not None:
+            embeddings = embed(self.sentbert_sample.items)
+            if self.sentbert_sample.sampled():
+                results["sentBERT"] = sampled_pairwise_cosine_distance(embeddings)
+            else:
+                distance = mean_pairwise_cosine_distance(embeddings)
+                results["sentBERT"] = (distance, distance, distance)
+        if self.self_bleu_sample is not None:
+            results["self-BLEU"] = self_bleu(self.self_bleu_sample.items)
+        return results
+
+
+def evaluate_groups(task):
+    """
+    Compute metrics for one shard of the groups of an output file. Run in a worker process for the n-gram metrics.
+
+    `task` is (input_file, args, mode, names, computed, shard, num_shards).
+    Of the metric results in `names`, only those whose (group key, name) is
+    not in `computed` are computed. Returns {(top-p, lambda): {"dist1": ...,
+    "sentBERT": ...}} for every group of the shard.
+    """
+    input_file, args, mode, names, computed, shard, num_shards = task
+    file_row, _ = file_info(input_file, args)
+    accumulators = {}
+    for (top_p, lamb), responses in read_groups(input_file, args, shard, num_shards):
+        if (top_p, lamb) not in accumulators:
+            key = group_key(mode, file_row + [top_p, lamb])
+            missing = [name for name in names if (key, name) not in computed]
+            sentbert = any(name.startswith("sentBERT") for name in missing)
+            if sentbert:
+                load_sentence_encoder(args)
+            accumulators[(top_p, lamb)] = GroupAccumulator(
+                dist_orders=[int(name[len("dist"):]) for name in missing if name.startswith("dist")],
+                entropy_orders=[int(name[len("entropy"):]) for name in missing if name.startswith("entropy")],
+                sentbert=sentbert, self_bleu=any(name.startswith("self-BLEU") for name in missing),
+                chunk_size=args.chunk_size, sentbert_sample=args.sentbert_sample,
+                self_bleu_sample=args.self_bleu_sample, seed=args.seed)
+        accumulators[(top_p, lamb)].add(responses)
+    return {key: accumulator.results() for key, accumulator in accumulators.items()}
+
+
+def evaluate_files(files, args, store, metrics, mode, pool=None):
+    """
+    Stream output files through per-group accumulators and store the results.
+
+    `files` are (input file, file hash, groups from an earlier run or None).
+    Only the `metrics` missing from `store` for a group are computed. With a
+    process pool, a task for each (file, shard of its groups) of all the
+    files is submitted at once. Each worker reads the whole file of its task
+    but cleans and counts only the groups of its shard, for the n-gram
+    metrics, while sentBERT is encoded in this process. Returns the [model
+    size, dataset size, top-p, lambda] of each group of each file, in the
+    order they are written to the results.
+    """
+    names = [name for name, _, _ in metrics]
+    ngram_names = [name for name in names if not name.startswith("sentBERT")]
+    shards = [[] for _ in files]
+    pending = []
+    for i, (input_file, file_hash, rows) in enumerate(files):
+        computed = store.computed(file_hash, metrics)
+        if pool is None:
+            shards[i].append(evaluate_groups((input_file, args, mode, names, computed, 0, 1)))
+            continue
+        # No more shards than groups: a baseline file is a single group, and an evaluated file's are known
+        num_shards = args.num_workers
+        if args.baseline:
+            num_shards = 1
+        elif rows:
+            num_shards = min(num_shards, len(rows))
+        for shard in range(num_shards):
+            task = (input_file, args, mode, ngram_names, computed, shard, num_shards)
+            pending.append((i, pool.apply_async(evaluate_groups, (task,))))
+        sentbert_names = [name for name in names if name.startswith("sentBERT") and
+                          (rows is None or any((group_key(mode, row), name) not in computed for row in rows))]
+        if sentbert_names:
+            shards[i].append(evaluate_groups((input_file, args, mode, sentbert_names, computed, 0, 1)))
+    for i, result in pending:
+        shards[i].append(result.get())
+
+    file_rows = []
+    for (input_file, file_hash, _), file_shards in zip(files, shards):
+        file_row, _ = file_info(input_file, args)
+        results = collections.defaultdict(dict)
+        for shard in file_shards:
+            for group, values in shard.items():
+                results[group].update(values)
+        rows = []
+        for top_p, lamb in sorted(results):
+            row = file_row + [top_p, lamb]
+            key = group_key(mode, row)
+            logging.info(f"Computed metrics for model: {row[0]}\tdataset: {row[1]}\ttop-p: {top_p}\tlambda: {lamb}")
+            for name, version, _ in metrics:
+                # Sampled results are named <metric>-sample<size>-seed<seed>
+                value = results[(top_p, lamb)].get(name.split("-sample")[0])
+                if value is not None:
+                    store.put(file_hash, key, name, version,
+                              [float(score) for score in value] if isinstance(value, tuple) else float(value))
+            rows.append(row)
+            if args.debug:
+                break
+        file_rows.append(rows)
+    return file_rows
 
 
 if __name__ == "__main__":
@@ -113,102 +901,58 @@ if __name__ == "__main__":
     if args.debug:
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
- 
-    # Write header to output CSV file
-    columns = ["model_size", "dataset_size", "top_p", "lambda"]
-    if "dist-n" in args.metrics:
-        columns.extend(["dist1", "dist2"])
-    if "sentBERT" in args.metrics:
-        columns.append("sentBERT")
-        if args.cpu:
-            device = "cpu"
-        else:
-            device = "cuda"
-            # Claim GPU
-            torch.ones(1).to(device)
-        # Instantiate model
-        sentbert_model = SentenceTransformer("bert-large-nli-stsb-mean-tokens").to(device)
-    
-    automatic_results = []
+
+    # Start the workers before any CUDA use, which does not survive a fork
+    pool = multiprocessing.Pool(args.num_workers) if args.num_workers > 1 else None
+
+    store = ResultsStore(args.results_store)
+    metrics = requested_metrics(args)
+    # How responses are grouped depends on these options
+    mode = "baseline" if args.baseline else "antilm" if args.antilm else "default"
+    mode += "-debug" if args.debug else ""
+
+    # Evaluate only the files with results missing from the store, all together
+    file_groups = []
+    missing = []
     for input_file in args.input_files:
         logging.info(f"On file {input_file}")
-        
-        if args.baseline:
-            # Get model and training info from filename
-            # Example format: /path/to/baseline_dummy_med_0.5.txt
-            dataset_size, top_p = input_file.split("/")[-1][:-4].split("_")[-2:]
-            if top_p == "argmax":
-                top_p = 0.0
-            model = "fusion"
-            model_size = "NA"
-            lamb = 0.0
-            with open(input_file) as f:
-                responses = [clean_response(i) for i in f.readlines()]
-            
-            row = [model_size, dataset_size, top_p, lamb]
-            logging.info(f"Calculating for model: {model_size}\tdataset: {dataset_size}\ttop-p: {top_p}\tlambda: {lamb}")
-            
-            if "dist-n" in args.metrics:
-                logging.info(f"\tComputing distinct-1")
-                dist1 = distinct_1(responses)
-
-                logging.info(f"\tComputing distinct-2")
-                dist2 = distinct_2(responses)
-                row.extend([dist1, dist2])
-            
-            if "sentBERT" in args.metrics:
-                logging.info(f"\tComputing SentBERT")
-                sentBERT_score = sentBERT(responses)
-                row.append(sentBERT_score)
-            
+        file_hash = hash_file(input_file)
+        rows = store.get(file_hash, "*", "groups", mode)
+        if rows is None or any(store.get(file_hash, group_key(mode, row), name, version) is None
+                               for row in rows for name, version, _ in metrics):
+            missing.append(len(file_groups))
+        else:
+            logging.info(f"\tAll {len(rows)} groups already evaluated")
+        file_groups.append((input_file, file_hash, rows))
+        if args.debug and args.baseline:
+            break
+    evaluated_rows = evaluate_files([file_groups[i] for i in missing], args, store, metrics, mode, pool)
+    for i, rows in zip(missing, evaluated_rows):
+        input_file, file_hash, stored_rows = file_groups[i]
+        if rows != stored_rows:
+            store.put(file_hash, "*", "groups", mode, rows)
+        file_groups[i] = (input_file, file_hash, rows)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if sentence_encoder is not None:
+        sentence_encoder.close()
+
+    # Rebuild the results from the store
+    columns = ["model_size", "dataset_size", "top_p", "lambda"]
+    for _, _, metric_columns in metrics:
+        columns.extend(metric_columns)
+    automatic_results = []
+    for _, file_hash, rows in file_groups:
+        for row in rows:
+            key = group_key(mode, row)
+            row = list(row)
+            for name, version, _ in metrics:
+                value = store.get(file_hash, key, name, version)
+                row.extend(value if isinstance(value, list) else [value])
             automatic_results.append(row)
 
-            if args.debug:
-                break
-        
-        else:
-            # Get model and training info from filename
-            # Example format: /path/to/gpt2_med_med.csv
-            model, model_size, dataset_size = input_file.split("/")[-1].split(".")[0].split("_")
-            
-            # Load and clean/tokenize the responses
-            df = pd.read_csv(input_file, index_col=0, quoting=QUOTE_ALL)
-            df["clean_response"] = df.response.map(lambda x: clean_response(x))
-            
-            df["prompt_id"] = df.index.map(lambda x: x.split("_")[0])
-            df["top_p"] = df.index.map(lambda x: x.split("_")[1])
-            if args.antilm:
-                df["lambda"] = df.index.map(lambda x: x.split("_")[2])
-            else:        
-                df["lambda"] = df.index.map(lambda x: 0.0)
-
-            for (top_p, lamb), temp in df.groupby(["top_p", "lambda"]):
-                row = [model_size, dataset_size, top_p, lamb]
-                logging.info(f"Calculating for model: {model_size}\tdataset: {dataset_size}\ttop-p: {top_p}\tlambda: {lamb}")
-                
-                responses = temp.clean_response.tolist()
-
-                if "dist-n" in args.metrics:
-                    logging.info(f"\tComputing distinct-1")
-                    dist1 = distinct_1(responses)
-
-                    logging.info(f"\tComputing distinct-2")
-                    dist2 = distinct_2(responses)
-                    row.extend([dist1, dist2])
-                
-                if "sentBERT" in args.metrics:
-                    logging.info(f"\tComputing SentBERT")
-                    sentBERT_score = sentBERT(responses)
-                    row.append(sentBERT_score)
-                
-                automatic_results.append(row)
-
-                if args.debug:
-                    break
-        
     logging.info(f"Saving results.")
     result_df = pd.DataFrame(automatic_results, columns=columns)
     result_df.to_csv(args.output_file)
     logging.info(result_df.head())
-
-
@@ -13,114 +13,915 @@ Modified: Alexandra DeLucia
 import sys
 import argparse
 import logging
+import os
 import csv
+import json
 import time
+import itertools
+import heapq
+import glob
+import multiprocessing
+import warnings
+import random
+import hashlib
+import queue
+import threading
+import collections
+import resource
+import contextlib
 
 # Third-party imports
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+import numpy as np
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer, GPT2TokenizerFast, PreTrainedTokenizerFast
+from transformers import CONFIG_NAME, WEIGHTS_NAME, GPT2PreTrainedModel
+from transformers.modeling_utils import Conv1D
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 
-def batchify(prompts, batch_size):
+def read_prompts(prompt_path):
     """
-    Batch prompts
+    Stream the prompts from a file, one per line
     """
-    # Edge case: 1 prompt per batch
-    if len(prompts) == batch_size:
-        return [[p] for p in prompts], [[i] for i in range(len(prompts))]
-    # Edge case: batch size of 1 (all prompts at once)
-    if batch_size == 1:
-        return [prompts], list(range(len(prompts)))
+    with open(prompt_path, 'r') as f:
+        for line in f:
+            yield f"{line.strip()} [RESPONSE]"
 
-    minibatches = []
-    minibatches_idx = []
+
+def encode_prompts(tokenizer, prompts):
+    """
+    Tokenize every prompt once, without padding
+    """
+    if isinstance(tokenizer, PreTrainedTokenizerFast):
+        # The Rust tokenizer encodes the whole list in parallel
+        return tokenizer.batch_encode_plus(prompts)["input_ids"] if prompts else []
+    return [tokenizer.encode(prompt) for prompt in prompts]
+
+
+def _file_sha256(path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest
+
+
+def prompt_cache_prefix(args, tokenizer):
+    """
+    Path prefix of the encoded-prompt cache for this tokenizer and prompt file.
+
+    The tokenizer is identified by its vocabulary files when they are on
+    disk, otherwise by its vocabulary.
+    """
+    tokenizer_digest = hashlib.sha256()
+    files = [os.path.join(args.model_name_or_path, name) for name in
+        sorted(tokenizer.vocab_files_names.values()) + ["added_tokens.json", "special_tokens_map.json"]]
+    files = [path for path in files if os.path.isfile(path)]
+    if files:
+        for path in files:
+            _file_sha256(path, tokenizer_digest)
+    else:
+        tokenizer_digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    prompt_digest = _file_sha256(args.prompt_path)
+    return os.path.join(args.prompt_cache_dir,
+        f"prompts_{prompt_digest.hexdigest()[:16]}_tok_{tokenizer_digest.hexdigest()[:16]}")
+
+
+def load_prompt_cache(args, tokenizer):
+    """
+    Memory-map the cached token ids and offsets, or return None if there is no cache
+    """
+    if not args.prompt_cache_dir:
+        return None
+    prefix = prompt_cache_prefix(args, tokenizer)
+    if not os.path.exists(f"{prefix}.offsets.npy"):
+        return None
+    logging.info(f"Loading encoded prompts from {prefix}")
+    return np.load(f"{prefix}.ids.npy", mmap_mode="r"), np.load(f"{prefix}.offsets.npy", mmap_mode="r")
+
+
+def cached_prompt(cache, idx):
+    """Token ids of prompt `idx` from a cache loaded with `load_prompt_cache`"""
+    ids, offsets = cache
+    return ids[offsets[idx]:offsets[idx + 1]].tolist()
+
+
+def _save_npy(path, array):
+    """np.save through a temporary file, so an interrupted save never leaves a truncated `path`"""
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+
+def save_prompt_cache(args, tokenizer, encoded_prompts):
+    """
+    Store encoded prompts as one flat int32 array of token ids plus offsets
+    """
+    os.makedirs(args.prompt_cache_dir, exist_ok=True)
+    prefix = prompt_cache_prefix(args, tokenizer)
+    offsets = np.zeros(len(encoded_prompts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in encoded_prompts])
+    ids = np.fromiter(itertools.chain.from_iterable(encoded_prompts), dtype=np.int32, count=int(offsets[-1]))
+    _save_npy(f"{prefix}.ids.npy", ids)
+    # The offsets mark a complete cache, so they are written last
+    _save_npy(f"{prefix}.offsets.npy", offsets)
+    logging.info(f"Cached encoded prompts at {prefix}")
+
+
+class PromptCacheWriter:
+    """
+    Build the encoded-prompt cache a window of prompts at a time, for --pipeline.
+
+    Token ids are appended to a raw temporary file as they are encoded, so
+    only the prompt lengths are held in memory. `close` turns it into the
+    same files as `save_prompt_cache`.
+    """
+    def __init__(self, args, tokenizer):
+        os.makedirs(args.prompt_cache_dir, exist_ok=True)
+        self.prefix = prompt_cache_prefix(args, tokenizer)
+        self.ids = open(f"{self.prefix}.ids.raw.tmp", "wb")
+        self.lengths = []
+
+    def write(self, encoded_prompts):
+        """Add the token ids of the next prompts, in prompt file order"""
+        for ids in encoded_prompts:
+            np.asarray(ids, dtype=np.int32).tofile(self.ids)
+            self.lengths.append(len(ids))
+
+    def close(self):
+        self.ids.close()
+        raw_path = f"{self.prefix}.ids.raw.tmp"
+        if os.path.getsize(raw_path):
+            ids = np.memmap(raw_path, dtype=np.int32, mode="r")
+        else:
+            ids = np.zeros(0, dtype=np.int32)
+        _save_npy(f"{self.prefix}.ids.npy", ids)
+        del ids
+        os.remove(raw_path)
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.lengths)
+        _save_npy(f"{self.prefix}.offsets.npy", offsets)
+        logging.info(f"Cached encoded prompts at {self.prefix}")
+
+
+def load_or_encode_prompts(args, tokenizer, prompts):
+    """
+    Token ids of every prompt, from the on-disk cache when there is one
+    """
+    cache = load_prompt_cache(args, tokenizer)
+    if cache is not None:
+        return [cached_prompt(cache, idx) for idx in range(len(prompts))]
+    encoded_prompts = encode_prompts(tokenizer, prompts)
+    if args.prompt_cache_dir:
+        save_prompt_cache(args, tokenizer, encoded_prompts)
+    return encoded_prompts
+
+
+def schedule_batches(lengths, batch_size, max_batch_tokens=None):
+    """
+    Group prompts into length-bucketed batches.
+
+    Prompts are sorted by token length so that each batch only holds prompts
+    of similar length. A batch is closed when it reaches `batch_size` prompts
+    or when its padded size (number of prompts x longest prompt) would go over
+    `max_batch_tokens`. Returns a list of lists of prompt indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (lengths[i], i))
+    batches = []
     curr_batch = []
-    curr_batch_idx = []
-    for i, prompt in enumerate(prompts):
-        if len(curr_batch) == batch_size:
-            minibatches.append(curr_batch)
-            minibatches_idx.append(curr_batch_idx)
-            curr_batch = [prompt]
-            curr_batch_idx = [i]
+    curr_max_len = 0
+    for i in order:
+        max_len = max(curr_max_len, lengths[i])
+        over_budget = max_batch_tokens is not None and max_len * (len(curr_batch) + 1) > max_batch_tokens
+        if curr_batch and (len(curr_batch) == batch_size or over_budget):
+            batches.append(curr_batch)
+            curr_batch = []
+            max_len = lengths[i]
+        curr_batch.append(i)
+        curr_max_len = max_len
+    if curr_batch:
+        batches.append(curr_batch)
+    return batches
+
+
+def padding_waste(lengths, batches):
+    """
+    Fraction of the padded prompt tokens in `batches` that are pad tokens
+    """
+    total = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    real = sum(lengths[i] for batch in batches for i in batch)
+    return (total - real) / total if total else 0.0
+
+
+def pad_batch(encoded_prompts, pad_token_id):
+    """
+    Left-pad a list of token id lists into `input_ids` and `attention_mask` tensors
+    """
+    max_len = max(len(ids) for ids in encoded_prompts)
+    input_ids = torch.full((len(encoded_prompts), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(encoded_prompts), max_len), dtype=torch.long)
+    for row, ids in enumerate(encoded_prompts):
+        if ids:
+            input_ids[row, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, max_len - len(ids):] = 1
+    return input_ids, attention_mask
+
+
+def _map_past(fn, *pasts):
+    """
+    Apply `fn(batch_dim, *tensors)` across the tensors of GPT-2 KV caches.
+
+    Handles both the stacked per-layer tensors of shape
+    (2, batch, heads, seq, head_dim) and (key, value) tuples of shape
+    (batch, heads, seq, head_dim). The sequence dimension is -2 in both.
+    """
+    mapped = []
+    for layers in zip(*pasts):
+        if isinstance(layers[0], torch.Tensor):
+            mapped.append(fn(1, *layers))
         else:
-            curr_batch.append(prompt)
-            curr_batch_idx.append(i)
-    # Check if extra prompts
-    if len(prompts) % batch_size != 0:
-        minibatches.append(curr_batch)
-        minibatches_idx.append(curr_batch_idx)
-    return minibatches, minibatches_idx
+            mapped.append(tuple(fn(0, *tensors) for tensors in zip(*layers)))
+    return tuple(mapped)
 
 
-def parse_args():
-    """Process commandline arguments"""
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--prompt-path", type=str, default="/home/aadelucia/gpt/writing_prompts/test.wp.src",
-        help="Path to prompts, delineated by newlines")
-    parser.add_argument("--output-path", type=str, default="output.csv", 
-        help="Output path for generated repsonses in CSV format with columns <id>,<prompt>,<response>")
-    parser.add_argument("--model-name-or-path", type=str, default=None, help="Path to model")
-    parser.add_argument("--top-p", type=float, nargs="+", default=[0.0, 0.3, 0.5, 0.7, 0.9, 0.95, 1.0], 
-        help="Top-p (nucleus sampling) values to test. Can pass more than one value. Default values were used in the paper.")
-    parser.add_argument("--length", type=int, default=200, help="Maximum length of response (not including prompt length)")
-    parser.add_argument("--bsz", type=int, default=20, help="Batch size")
-    parser.add_argument("--display-progress", type=int, default=100, help="How often to print the generation progress")
-    
-    parser.add_argument("--seed", type=int, default=42, help="Random seed for initialization")
-    parser.add_argument("--no-cuda", action="store_true", help="Avoid using CUDA even if available")
+def _select_past(past, index):
+    """Select batch rows of a KV cache"""
+    return _map_past(lambda dim, t: t.index_select(dim, index), past)
 
-    args = parser.parse_args()
-    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-    return args
 
+def _pad_past(past, num_pad):
+    """Left-pad the sequence dimension of a KV cache with zeros"""
+    if num_pad == 0:
+        return past
+    return _map_past(lambda dim, t: torch.nn.functional.pad(t, (0, 0, num_pad, 0)), past)
 
-if __name__ == "__main__":
-    # Load training parameters
-    args = parse_args()
 
-    # Claim the GPU (research cluster-specific issue)
-    try:
-        torch.ones(1).to(args.device)
-    except RuntimeError as err:
-        logging.error(err)
-        sys.exit(1)
+def _trim_past(past, start):
+    """Drop the first `start` positions of a KV cache"""
+    if start == 0:
+        return past
+    return _map_past(lambda dim, t: t.narrow(-2, start, t.size(-2) - start), past)
 
-    # Load pre-trained OpenAI GPT-2 model
-    tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
-    model = GPT2LMHeadModel.from_pretrained(args.model_name_or_path)
-    model.to(args.device)
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "left"  # Hack to be able to batch generate
 
-    # Load and batch the prompts for quicker generation
-    logging.info(f"Loading prompts from {args.prompt_path}")
-    prompt_lst = []
-    with open(args.prompt_path, 'r') as f:
-        prompt_lst = [f"{line.strip()} [RESPONSE]" for line in f.readlines()]
-    logging.info("total number of sentences = {}".format(len(prompt_lst)))
-    prompt_lst_batch, prompt_lst_batch_idx = batchify(prompt_lst, args.bsz)
-    logging.info("total batch size = {}".format(len(prompt_lst_batch)))
+def _cat_past(past_a, past_b):
+    """Concatenate the batch rows of two KV caches with the same sequence length"""
+    return _map_past(lambda dim, a, b: torch.cat([a, b], dim=dim), past_a, past_b)
+
+
+def _forward(model, input_ids, past, attention_mask, position_ids):
+    """
+    Run one cached forward pass and return the last-position logits and the new cache
+    """
+    outputs = model(input_ids, past=past, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+    return outputs[0][:, -1, :], outputs[1]
+
+
+def top_p_filter(logits, top_p, temperature=None):
+    """
+    Nucleus filtering with a separate p and temperature for every row.
+
+    `top_p` and `temperature` are float tensors with one value per row of
+    `logits`. Logits are divided by the temperature, then tokens outside each
+    row's nucleus are set to -inf with one sort and cumsum for the whole
+    batch. A p of 0.0 keeps only the most likely token, so sampling from the
+    result is greedy decoding, and a p of 1.0 keeps every token.
+    """
+    if temperature is not None:
+        logits = logits / temperature.unsqueeze(-1)
+    if bool((top_p >= 1.0).all()):
+        return logits
+    if bool((top_p <= 0.0).all()):
+        # Greedy rows only, no need to sort
+        greedy = logits.argmax(-1, keepdim=True)
+        return torch.full_like(logits, float("-inf")).scatter(1, greedy, logits.gather(1, greedy))
+    sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+    cum_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+    # Rounding can push the cumulative sum past 1.0, so p >= 1.0 rows are never cut
+    sorted_to_remove = (cum_probs > top_p.unsqueeze(-1)) & (top_p < 1.0).unsqueeze(-1)
+    # Shift right to keep the first token above the threshold
+    sorted_to_remove[:, 1:] = sorted_to_remove[:, :-1].clone()
+    sorted_to_remove[:, 0] = False
+    to_remove = sorted_to_remove.scatter(1, sorted_idx, sorted_to_remove)
+    return logits.masked_fill(to_remove, float("-inf"))
+
+
+def row_seed(seed, prompt_idx, top_p, lamb=0.0):
+    """
+    Seed of the sampling stream of one (prompt, top-p, lambda) row.
+
+    Derived from the run's --seed and the row itself, so a row samples the
+    same tokens however the prompts are batched, sharded or resumed.
+    """
+    key = f"{seed}_{prompt_idx}_{top_p}_{lamb}".encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], "little") & (2**63 - 1)
+
+
+def sample_rows(probs, generators):
+    """
+    Draw one token per row of `probs`, each from that row's own `torch.Generator`.
+
+    Uses inverse transform sampling on the cumulative probabilities, so each
+    row consumes exactly one uniform number per step from its own stream.
+    """
+    uniform = torch.cat([torch.rand(1, generator=generator) for generator in generators]).to(probs.device)
+    cum_probs = probs.cumsum(-1)
+    # First token whose cumulative probability exceeds the draw, skipping zero-probability tokens
+    threshold = (uniform * cum_probs[:, -1]).unsqueeze(-1)
+    return (cum_probs <= threshold).sum(-1).clamp(max=probs.size(-1) - 1)
+
+
+class DecodeStats:
+    """
+    Counters for the fused decoder
+    """
+    def __init__(self):
+        self.generated_tokens = 0
+        self.prefill_tokens = 0
+        self.kv_slots = 0
+        self.kv_useful = 0
+        self.start_time = time.time()
 
-    # Start the output file
-    f = open(args.output_path, "w+", newline="")
-    writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-    writer.writerow(["id", "prompt", "response"])
+    def tokens_per_sec(self):
+        elapsed = time.time() - self.start_time
+        return self.generated_tokens / elapsed if elapsed > 0 else 0.0
 
-    for i, (prompts, prompts_idx) in enumerate(zip(prompt_lst_batch, prompt_lst_batch_idx)):
+    def useful_share(self):
+        """Share of the attended cache positions that hold real (non-pad) tokens"""
+        return self.kv_useful / self.kv_slots if self.kv_slots else 1.0
+
+    def summary(self):
+        return (f"{self.generated_tokens} tokens generated, {self.tokens_per_sec():.1f} tokens/sec, "
+                f"useful token share {self.useful_share():.3f}")
+
+
+class StageMetrics:
+    """
+    Per-stage timings, written as JSON lines to --metrics-path.
+
+    Every record has the stage name, its wall time in seconds, counts such as
+    tokens and padding, and the peak memory of the process so far. Records
+    are appended one line at a time, so shard workers can share a file.
+    Nothing is recorded until `open` is called with a path.
+    """
+    def __init__(self):
+        self.file = None
+        self.fields = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def open(self, path, **fields):
+        """Start appending records to `path`, each tagged with `fields`"""
+        if path:
+            self.file = open(path, "a")
+            self.fields = dict(fields, pid=os.getpid())
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def record(self, stage, seconds, **counts):
+        if self.file is None:
+            return
+        row = {"stage": stage, "seconds": round(seconds, 6), **self.fields, **counts, "time": round(time.time(), 3)}
+        # ru_maxrss is in kilobytes on Linux
+        row["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1)
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            row["peak_cuda_mb"] = round(torch.cuda.max_memory_allocated() / 2**20, 1)
+        with self.lock:
+            self.file.write(json.dumps(row) + "\n")
+            self.file.flush()
+
+    def accumulate(self, stage, seconds, every, **counts):
+        """Add one prompt's time to a running total for `stage`, recorded once every `every` prompts"""
+        if self.file is None:
+            return
+        total = self.pending.setdefault(stage, {"seconds": 0.0, "prompts": 0})
+        total["seconds"] += seconds
+        total["prompts"] += 1
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+        if total["prompts"] >= every:
+            self.flush(stage)
+
+    def flush(self, stage):
+        """Record the running total of `stage`, if there is one"""
+        total = self.pending.pop(stage, None)
+        if total is not None:
+            self.record(stage, total.pop("seconds"), **total)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+metrics = StageMetrics()
+
+
+class BatchProfiler:
+    """
+    Runs the torch autograd profiler over a range of batches.
+
+    Call `step` with the index of each batch as it starts. Profiling starts
+    at batch `start`, and the Chrome trace is written to `path` after batch
+    `end` (inclusive) or when `stop` is called.
+    """
+    def __init__(self, batch_range, path, use_cuda=False):
+        self.start, self.end = batch_range if batch_range else (None, None)
+        self.path = path
+        self.use_cuda = use_cuda
+        self.profile = None
+
+    def step(self, batch_idx):
+        if self.start is None:
+            return
+        if self.profile is None and self.start <= batch_idx <= self.end:
+            self.profile = torch.autograd.profiler.profile(**({"use_cuda": True} if self.use_cuda else {}))
+            self.profile.__enter__()
+        elif self.profile is not None and batch_idx > self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.__exit__(None, None, None)
+        self.profile.export_chrome_trace(self.path)
+        logging.info(f"Wrote the profile of batches {self.start}-{self.end} to {self.path}")
+        self.profile = None
+        self.start = None
+
+
+def batch_profiler(args):
+    """The profiler for --profile-batches, which does nothing when the option is not set"""
+    return BatchProfiler(args.profile_batches, args.profile_path or f"{args.output_path}.trace.json",
+        use_cuda=args.device.type == "cuda")
+
+
+def _left_align(past_a, mask_a, past_b, mask_b):
+    """Left-pad two KV caches and their attention masks to the same sequence length"""
+    width_a, width_b = mask_a.size(1), mask_b.size(1)
+    past_a, past_b = _pad_past(past_a, max(width_b - width_a, 0)), _pad_past(past_b, max(width_a - width_b, 0))
+    mask_a = torch.nn.functional.pad(mask_a, (max(width_b - width_a, 0), 0))
+    mask_b = torch.nn.functional.pad(mask_b, (max(width_a - width_b, 0), 0))
+    return past_a, mask_a, past_b, mask_b
+
+
+class _ActiveRows:
+    """
+    Decoding state of the rows currently in the batch.
+
+    Every row is one (prompt, config) pair. Rows keep their own generated
+    tokens, while the logits, KV cache, attention mask and positions are
+    batched tensors that are compacted as rows finish.
+
+    For anti-LM decoding (`paired`), each row also has an unconditional row
+    that sees only the response. The batched tensors then hold all
+    conditional rows followed by all unconditional rows, in the same order,
+    so one forward pass covers both. `nodes` holds each row's position in
+    the unconditional prefix cache (None when it has left the cache).
+    """
+    def __init__(self, meta, logits, past, attention_mask, positions, top_p, temperature, lambdas, paired=False):
+        self.meta = meta
+        self.tokens = [[] for _ in meta]
+        self.nodes = [None for _ in meta]
+        self.generators = [None for _ in meta]
+        self.logits = logits
+        self.past = past
+        self.attention_mask = attention_mask
+        self.positions = positions
+        self.top_p = top_p
+        self.temperature = temperature
+        self.lambdas = lambdas
+        self.paired = paired
+
+    def __len__(self):
+        return len(self.meta)
+
+    def select(self, keep):
+        """Keep only the rows in the list `keep`"""
+        device = self.logits.device
+        index = torch.tensor(keep, dtype=torch.long, device=device)
+        batch_index = torch.cat([index, index + len(self)]) if self.paired else index
+        self.meta = [self.meta[j] for j in keep]
+        self.tokens = [self.tokens[j] for j in keep]
+        self.nodes = [self.nodes[j] for j in keep]
+        self.generators = [self.generators[j] for j in keep]
+        self.logits = self.logits.index_select(0, batch_index)
+        self.past = _select_past(self.past, batch_index)
+        self.attention_mask = self.attention_mask.index_select(0, batch_index)
+        self.positions = self.positions.index_select(0, batch_index)
+        self.top_p = self.top_p.index_select(0, index)
+        self.temperature = self.temperature.index_select(0, index)
+        self.lambdas = self.lambdas.index_select(0, index)
+        # Drop leading cache positions that are padding for every remaining row
+        start = int((self.attention_mask.sum(0) > 0).nonzero()[0])
+        self.past = _trim_past(self.past, start)
+        self.attention_mask = self.attention_mask[:, start:]
+
+    def extend(self, other):
+        """Add the rows of `other`, left-padding whichever cache is shorter"""
+        past, mask, other_past, other_mask = _left_align(self.past, self.attention_mask, other.past, other.attention_mask)
+        n, m = len(self), len(other)
+
+        def merge(dim, a, b):
+            if not self.paired:
+                return torch.cat([a, b], dim=dim)
+            # Conditional rows of both, then unconditional rows of both
+            return torch.cat([a.narrow(dim, 0, n), b.narrow(dim, 0, m), a.narrow(dim, n, n), b.narrow(dim, m, m)], dim=dim)
+
+        self.meta += other.meta
+        self.tokens += other.tokens
+        self.nodes += other.nodes
+        self.generators += other.generators
+        self.logits = merge(0, self.logits, other.logits)
+        self.past = _map_past(merge, past, other_past)
+        self.attention_mask = merge(0, mask, other_mask)
+        self.positions = merge(0, self.positions, other.positions)
+        self.top_p = torch.cat([self.top_p, other.top_p])
+        self.temperature = torch.cat([self.temperature, other.temperature])
+        self.lambdas = torch.cat([self.lambdas, other.lambdas])
+
+
+def _past_nbytes(past):
+    """Memory held by the tensors of a KV cache"""
+    sizes = []
+    _map_past(lambda dim, t: sizes.append(t.numel() * t.element_size()), past)
+    return sum(sizes)
+
+
+class _PrefixNode:
+    """A response prefix in the `PrefixCache` trie"""
+    __slots__ = ("parent", "token", "children", "logits", "column", "nbytes", "cached")
+
+    def __init__(self, parent, token, logits, column):
+        self.parent = parent
+        self.token = token
+        self.children = {}
+        self.logits = logits
+        self.column = column
+        self.nbytes = 0
+        self.cached = True
+
+
+class PrefixCache:
+    """
+    LRU cache of the unconditional anti-LM pass, keyed by response prefix.
+
+    The unconditional model only sees the fixed context and the response so
+    far, so rows with the same response prefix get the same result no matter
+    the prompt or lambda. Prefixes form a trie of token ids. Each node holds
+    the logits after its last token and the KV cache column that token adds,
+    which is all a row needs to skip its unconditional forward pass.
+
+    The root holds the context's logits and KV cache. Once the nodes hold
+    more than `max_bytes`, leaves are evicted least recently used first, so
+    every cached prefix keeps its whole path.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.root = _PrefixNode(None, None, None, None)
+        # Evictable nodes (those without children), least recently used first
+        self.leaves = collections.OrderedDict()
+        self.num_nodes = 0
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, node, token):
+        """Return the child of `node` for `token`, or None on a miss"""
+        child = node.children.get(token) if node is not None and node.cached else None
+        if child is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if child in self.leaves:
+            self.leaves.move_to_end(child)
+        return child
+
+    def insert(self, node, token, logits, column):
+        """Add the child of `node` for `token`. Returns None if it could not be kept."""
+        if node is None or not node.cached:
+            return None
+        if token in node.children:
+            return self.lookup(node, token)
+        column = _map_past(lambda dim, t: t.clone(), column)
+        child = _PrefixNode(node, token, logits.clone(), column)
+        child.nbytes = child.logits.numel() * child.logits.element_size() + _past_nbytes(column)
+        node.children[token] = child
+        self.leaves.pop(node, None)
+        self.leaves[child] = None
+        self.num_nodes += 1
+        self.num_bytes += child.nbytes
+        while self.num_bytes > self.max_bytes and self.leaves:
+            self._evict(next(iter(self.leaves)))
+        return child if child.cached else None
+
+    def _evict(self, node):
+        del self.leaves[node]
+        parent = node.parent
+        del parent.children[node.token]
+        if parent is not self.root and not parent.children:
+            # The parent was last used before its child, so it is next in line
+            self.leaves[parent] = None
+            self.leaves.move_to_end(parent, last=False)
+        self.num_nodes -= 1
+        self.num_bytes -= node.nbytes
+        self.evictions += 1
+        node.cached = False
+        node.logits, node.column = None, None
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return (f"anti-LM cache hit rate {self.hit_rate():.3f} ({self.hits} hits, {self.misses} misses), "
+                f"{self.num_nodes} prefixes in {self.num_bytes / 2**20:.1f} MB, {self.evictions} evicted")
+
+
+class FusedDecoder:
+    """
+    Decoder that prefills each prompt once and decodes every config together.
+
+    A config is a (top-p, lambda) pair. Each prompt is run through the model
+    once, then its KV cache and last logits are repeated for each config
+    (p=0.0 is greedy decoding). Rows leave the batch as soon as they emit the
+    end-of-text token or reach `length` new tokens, and the freed slots are
+    refilled with waiting prompts (continuous batching), so no compute is
+    spent on finished rows.
+
+    If any lambda is non-zero, decoding uses the MMI anti-LM objective
+    log p(y | x) - lambda * log p(y). The unconditional p(y) comes from the
+    same model given only `antilm_context` and the response so far. It runs
+    in the same forward pass as the conditional rows, with its own KV cache.
+    With `antilm_cache_bytes`, unconditional results are kept in a
+    `PrefixCache` and rows whose response prefix is cached skip that pass.
+    """
+    def __init__(self, model, configs, length, eos_token_id, pad_token_id, max_rows, device, antilm_context=None,
+                 antilm_cache_bytes=0, temperature=1.0, seed=42):
+        self.model = model
+        self.configs = list(configs)
+        self.length = length
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_rows = max(max_rows, len(self.configs))
+        self.device = device
+        self.antilm = any(lamb != 0.0 for _, lamb in self.configs)
+        self.temperature = temperature
+        self.seed = seed
+        self.antilm_context = antilm_context or [eos_token_id]
+        self.cache = PrefixCache(antilm_cache_bytes) if self.antilm and antilm_cache_bytes > 0 else None
+        self.stats = DecodeStats()
+        self.profiler = None
+
+    def _prefill(self, prompts):
+        """Run the prompts through the model and fan each one out to every config"""
+        num_configs = len(self.configs)
+        input_ids, attention_mask = pad_batch([ids for _, ids in prompts], self.pad_token_id)
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        # Position ids skip the left padding
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits, past = _forward(self.model, input_ids, None, attention_mask, position_ids)
+        self.stats.prefill_tokens += int(attention_mask.sum())
+
+        num_rows = len(prompts) * num_configs
+        expand_idx = torch.arange(len(prompts), device=self.device).repeat_interleave(num_configs)
+        logits = logits.index_select(0, expand_idx)
+        past = _select_past(past, expand_idx)
+        attention_mask = attention_mask.index_select(0, expand_idx)
+        positions = position_ids[:, -1].index_select(0, expand_idx)
+
+        if self.antilm:
+            # The unconditional context is the same for every row, so it is run once
+            context = torch.tensor([self.antilm_context], dtype=torch.long, device=self.device)
+            context_positions = torch.arange(context.size(1), device=self.device).unsqueeze(0)
+            if self.cache is not None and self.cache.root.logits is not None:
+                uncond_logits, uncond_past = self.cache.root.logits, self.cache.root.column
+            else:
+                uncond_logits, uncond_past = _forward(self.model, context, None, torch.ones_like(context), context_positions)
+                if self.cache is not None:
+                    self.cache.root.logits, self.cache.root.column = uncond_logits, uncond_past
+            uncond_index = torch.zeros(num_rows, dtype=torch.long, device=self.device)
+            uncond_past = _select_past(uncond_past, uncond_index)
+            uncond_mask = torch.ones((num_rows, context.size(1)), dtype=torch.long, device=self.device)
+            past, attention_mask, uncond_past, uncond_mask = _left_align(past, attention_mask, uncond_past, uncond_mask)
+            logits = torch.cat([logits, uncond_logits.index_select(0, uncond_index)])
+            past = _cat_past(past, uncond_past)
+            attention_mask = torch.cat([attention_mask, uncond_mask])
+            positions = torch.cat([positions, context_positions[:, -1].expand(num_rows)])
+
+        meta = [(prompt_idx, config_idx) for prompt_idx, _ in prompts for config_idx in range(num_configs)]
+        top_p = torch.tensor([p for p, _ in self.configs], dtype=torch.float, device=self.device).repeat(len(prompts))
+        temperature = torch.full((num_rows,), self.temperature, dtype=torch.float, device=self.device)
+        lambdas = torch.tensor([lamb for _, lamb in self.configs], dtype=torch.float, device=self.device).repeat(len(prompts))
+        rows = _ActiveRows(meta, logits, past, attention_mask, positions, top_p, temperature, lambdas, paired=self.antilm)
+        if self.cache is not None:
+            rows.nodes = [self.cache.root] * num_rows
+        # Every row samples from its own stream, so batching does not change its output
+        for j, (prompt_idx, config_idx) in enumerate(meta):
+            rows.generators[j] = torch.Generator()
+            rows.generators[j].manual_seed(row_seed(self.seed, prompt_idx, *self.configs[config_idx]))
+        return rows
+
+    def _sample(self, rows):
+        scores = rows.logits[:len(rows)]
+        if rows.paired:
+            uncond = rows.logits[len(rows):]
+            scores = torch.log_softmax(scores, dim=-1) - rows.lambdas.unsqueeze(-1) * torch.log_softmax(uncond, dim=-1)
+        # Greedy rows (p=0.0) keep only their top token, so they are sampled like the rest
+        probs = torch.softmax(top_p_filter(scores, rows.top_p, rows.temperature), dim=-1)
+        return sample_rows(probs, rows.generators)
+
+    @torch.no_grad()
+    def decode(self, prompts):
+        """
+        Decode an iterable of (prompt index, token ids) pairs.
+
+        Yields (prompt index, config index, generated token ids) as rows
+        finish, so results arrive out of prompt order.
+        """
+        prompts = iter(prompts)
+        num_configs = len(self.configs)
+        rows = None
+        exhausted = False
+        # Each refill starts a new "batch" for the metrics and the profiler
+        num_refills = 0
+        interval = None
+        while True:
+            # Refill free slots with waiting prompts
+            num_free = (self.max_rows - (len(rows) if rows else 0)) // num_configs
+            if not exhausted and num_free > 0:
+                waiting = list(itertools.islice(prompts, num_free))
+                exhausted = len(waiting) < num_free
+                if waiting:
+                    self._record_decode(interval)
+                    if self.profiler is not None:
+                        self.profiler.step(num_refills)
+                    start_time = time.time()
+                    prefill_tokens = self.stats.prefill_tokens
+                    new_rows = self._prefill(waiting)
+                    if rows:
+                        rows.extend(new_rows)
+                    else:
+                        rows = new_rows
+                    prompt_tokens = self.stats.prefill_tokens - prefill_tokens
+                    padded_tokens = len(waiting) * max(len(ids) for _, ids in waiting)
+                    metrics.record("prefill", time.time() - start_time, batch=num_refills, prompts=len(waiting),
+                        rows=len(new_rows), prompt_tokens=prompt_tokens, pad_fraction=round(1 - prompt_tokens / padded_tokens, 4))
+                    interval = {"batch": num_refills, "seconds": 0.0, "steps": 0, "generated_tokens": 0,
+                        "kv_slots": self.stats.kv_slots, "kv_useful": self.stats.kv_useful, "top_p_tokens": {}}
+                    num_refills += 1
+            if not rows:
+                self._record_decode(interval)
+                if self.profiler is not None:
+                    self.profiler.stop()
+                return
+
+            start_time = time.time()
+            next_tokens = self._sample(rows)
+            finished, keep = [], []
+            for j, token in enumerate(next_tokens.tolist()):
+                rows.tokens[j].append(token)
+                if token == self.eos_token_id or len(rows.tokens[j]) >= self.length:
+                    prompt_idx, config_idx = rows.meta[j]
+                    finished.append((prompt_idx, config_idx, rows.tokens[j]))
+                else:
+                    keep.append(j)
+            self.stats.generated_tokens += len(rows)
+            if metrics.enabled:
+                for _, config_idx in rows.meta:
+                    p = str(self.configs[config_idx][0])
+                    interval["top_p_tokens"][p] = interval["top_p_tokens"].get(p, 0) + 1
+                interval["generated_tokens"] += len(rows)
+                interval["steps"] += 1
+
+            # Drop finished rows from the batch and the cache
+            if not keep:
+                rows = None
+            else:
+                if len(keep) < len(rows):
+                    next_tokens = next_tokens.index_select(0, torch.tensor(keep, device=self.device))
+                    rows.select(keep)
+                self._advance(rows, next_tokens)
+            interval["seconds"] += time.time() - start_time
+            yield from finished
+
+    def _record_decode(self, interval):
+        """Record the decoding steps run since the last refill"""
+        if interval is None or not interval["steps"]:
+            return
+        kv_slots = self.stats.kv_slots - interval.pop("kv_slots")
+        kv_useful = self.stats.kv_useful - interval.pop("kv_useful")
+        interval["pad_fraction"] = round(1 - kv_useful / kv_slots, 4) if kv_slots else 0.0
+        metrics.record("decode", interval.pop("seconds"), **interval)
+
+    def _advance(self, rows, next_tokens):
+        """Feed each row its sampled token and update the logits and KV cache"""
+        num_batch = rows.attention_mask.size(0)
+        rows.attention_mask = torch.cat([rows.attention_mask, rows.attention_mask.new_ones((num_batch, 1))], dim=-1)
+        rows.positions = rows.positions + 1
+        self.stats.kv_slots += rows.attention_mask.numel()
+        self.stats.kv_useful += int(rows.attention_mask.sum())
+        if not rows.paired:
+            rows.logits, rows.past = _forward(self.model, next_tokens.unsqueeze(-1), rows.past,
+                rows.attention_mask, rows.positions.unsqueeze(-1))
+            return
+        if self.cache is None:
+            # Unconditional rows are fed the same tokens as their conditional rows
+            input_ids = torch.cat([next_tokens, next_tokens])
+            rows.logits, rows.past = _forward(self.model, input_ids.unsqueeze(-1), rows.past,
+                rows.attention_mask, rows.positions.unsqueeze(-1))
+            return
+
+        n = len(rows)
+        tokens = next_tokens.tolist()
+        children = [self.cache.lookup(node, token) for node, token in zip(rows.nodes, tokens)]
+        hits = [j for j, child in enumerate(children) if child is not None]
+        # Rows that miss with the same prefix are only run once
+        misses, shared, first_miss = [], {}, {}
+        for j, child in enumerate(children):
+            if child is not None:
+                continue
+            key = (rows.nodes[j], tokens[j])
+            if rows.nodes[j] is not None and key in first_miss:
+                shared[j] = first_miss[key]
+            else:
+                first_miss[key] = len(misses)
+                misses.append(j)
+        # Read the hits now, inserting the misses below may evict them
+        hit_logits = [children[j].logits for j in hits]
+        hit_columns = [children[j].column for j in hits]
+
+        # Run the conditional rows and only the unconditional rows that missed
+        past, attention_mask, positions = rows.past, rows.attention_mask, rows.positions
+        miss_index = torch.tensor(misses, dtype=torch.long, device=self.device)
+        if hits or shared:
+            index = torch.cat([torch.arange(n, device=self.device), miss_index + n])
+            past = _select_past(past, index)
+            attention_mask = attention_mask.index_select(0, index)
+            positions = positions.index_select(0, index)
+        input_ids = torch.cat([next_tokens, next_tokens.index_select(0, miss_index)])
+        logits, past = _forward(self.model, input_ids.unsqueeze(-1), past, attention_mask, positions.unsqueeze(-1))
+
+        for i, j in enumerate(misses):
+            column = _map_past(lambda dim, t: t.narrow(dim, n + i, 1).narrow(-2, t.size(-2) - 1, 1), past)
+            children[j] = self.cache.insert(rows.nodes[j], tokens[j], logits[n + i], column)
+        for j, i in shared.items():
+            children[j] = children[misses[i]]
+        rows.nodes = children
+        if not hits and not shared:
+            rows.logits, rows.past = logits, past
+            return
+
+        # Put the cached logits and KV cache columns of the hits back in row order
+        order = list(range(n)) + [0] * n
+        for i, j in enumerate(misses):
+            order[n + j] = n + i
+        for j, i in shared.items():
+            order[n + j] = n + i
+        for i, j in enumerate(hits):
+            order[n + j] = n + len(misses) + i
+        order = torch.tensor(order, dtype=torch.long, device=self.device)
+        rows.logits = torch.cat([logits] + ([torch.stack(hit_logits)] if hits else [])).index_select(0, order)
+
+        def new_column(dim, computed, *cached):
+            computed = computed.narrow(-2, computed.size(-2) - 1, 1)
+            return torch.cat([computed] + list(cached), dim=dim).index_select(dim, order)
+
+        column = _map_past(new_column, past, *hit_columns)
+        rows.past = _map_past(lambda dim, t, c: torch.cat([t, c], dim=-2), rows.past, column)
+
+
+def generate_hf(model, tokenizer, args, batches):
+    """
+    Generate with `model.generate`, one call per batch and top-p value.
+
+    `batches` is an iterable of lists of (prompt index, token ids). Yields
+    (prompt index, list of generated token ids per top-p value).
+    """
+    profiler = batch_profiler(args)
+    for i, batch in enumerate(batches):
         # Log progress
         if i % args.display_progress == 0:
-            logging.info(f"On batch {i} out of {len(prompt_lst_batch)}")
-    
-        # Encode prompts
-        encoded_prompt_dict = tokenizer.batch_encode_plus(prompts, return_tensors="pt", pad_to_max_length=True)
-        encoded_prompt = encoded_prompt_dict['input_ids'].to(args.device)
-        encoded_mask = encoded_prompt_dict['attention_mask'].to(args.device)
+            logging.info(f"On batch {i}")
+        profiler.step(i)
+
+        # Pad the already encoded prompts
+        prompts_idx = [idx for idx, _ in batch]
+        encoded_prompt, encoded_mask = pad_batch([ids for _, ids in batch], tokenizer.pad_token_id)
+        encoded_prompt = encoded_prompt.to(args.device)
+        encoded_mask = encoded_mask.to(args.device)
         end_of_prompt_idx = len(encoded_prompt[0])
 
+        batch_outputs = {idx: [] for idx in prompts_idx}
+        prompt_tokens = int(encoded_mask.sum())
         for p in args.top_p:
+            start_time = time.time()
+            # model.generate samples from the global RNG, so seed it per batch and top-p value
+            torch.manual_seed(row_seed(args.seed, prompts_idx[0], p))
             # Greedy decoding
             if p == 0.0:
                 output_sequences = model.generate(
@@ -129,7 +930,7 @@ if __name__ == "__main__":
                     temperature=1.0,
                     top_k=0,
                     top_p=0,
-                    pad_token_id=50256,
+                    pad_token_id=tokenizer.eos_token_id,
                     repetition_penalty=1.0,
                     do_sample=False,
                     num_beams=1,
@@ -141,10 +942,10 @@ if __name__ == "__main__":
                 output_sequences = model.generate(
                     input_ids=encoded_prompt,
                     max_length=args.length + len(encoded_prompt[0]),
-                    temperature=1.0,
+                    temperature=args.temperature,
                     top_k=0,
                     top_p=p,
-                    pad_token_id=50256,
+                    pad_token_id=tokenizer.eos_token_id,
                     repetition_penalty=1.0,
                     do_sample=True,
                     num_beams=1,
@@ -156,15 +957,1102 @@ if __name__ == "__main__":
             if len(output_sequences.shape) > 2:
                 output_sequences.squeeze_()
 
-            for prompt_id, prompt, generated_sequence in zip(prompts_idx, prompts, output_sequences):
-                # Only decode the generated response, skip the prompt
-                generated_sequence = generated_sequence.tolist()[end_of_prompt_idx:]
+            generated_tokens = 0
+            for prompt_id, generated_sequence in zip(prompts_idx, output_sequences):
+                # Only keep the generated response, skip the prompt
+                response = generated_sequence.tolist()[end_of_prompt_idx:]
+                batch_outputs[prompt_id].append(response)
+                # Finished rows are padded with end-of-text tokens
+                if tokenizer.eos_token_id in response:
+                    generated_tokens += response.index(tokenizer.eos_token_id) + 1
+                else:
+                    generated_tokens += len(response)
+            # model.generate runs the prefill and the decoding steps together
+            metrics.record("generate", time.time() - start_time, batch=i, top_p=p, prompts=len(batch),
+                prompt_tokens=prompt_tokens, pad_fraction=round(1 - prompt_tokens / encoded_mask.numel(), 4),
+                generated_tokens=generated_tokens)
+
+        yield from batch_outputs.items()
+    profiler.stop()
+
+
+def generate_fused(model, tokenizer, args, batches):
+    """
+    Generate with the continuous-batching `FusedDecoder`.
+
+    `batches` is an iterable of lists of (prompt index, token ids). Prompts
+    are fed in that (length-sorted) order, with up to --bsz prompts x configs
+    rows decoding at once. Yields (prompt index, list of generated token ids
+    per (top-p, lambda) config) as soon as all of a prompt's rows are done.
+    """
+    decoder = FusedDecoder(model, args.configs, args.length, tokenizer.eos_token_id, tokenizer.pad_token_id,
+        args.bsz * len(args.configs), args.device, antilm_cache_bytes=int(args.antilm_cache_mb * 2**20),
+        temperature=args.temperature, seed=args.seed)
+    decoder.profiler = batch_profiler(args)
+    scheduled = (prompt for batch in batches for prompt in batch)
+    pending = {}
+    num_done = 0
+    for prompt_id, config_idx, generated_sequence in decoder.decode(scheduled):
+        outputs = pending.setdefault(prompt_id, [None] * len(args.configs))
+        outputs[config_idx] = generated_sequence
+        if all(output is not None for output in outputs):
+            yield prompt_id, pending.pop(prompt_id)
+            num_done += 1
+            # Log progress
+            if num_done % args.display_progress == 0:
+                logging.info(f"Finished {num_done} prompts. {decoder.stats.summary()}")
+                if decoder.cache is not None:
+                    logging.info(decoder.cache.summary())
+    logging.info(decoder.stats.summary())
+    if decoder.cache is not None:
+        logging.info(decoder.cache.summary())
+
+
+def row_ids(args, prompt_id):
+    """
+    Output ids of a prompt's rows, one per (top-p, lambda) config.
+
+    The id is <prompt id>_<top-p>, or <prompt id>_<top-p>_<lambda> for anti-LM runs.
+    """
+    if args.lambdas:
+        return [f"{prompt_id}_{p}_{lamb}" for p, lamb in args.configs]
+    return [f"{prompt_id}_{p}" for p, _ in args.configs]
+
+
+class OrderedRowWriter:
+    """
+    Write CSV rows in prompt-id order when prompts finish out of order.
+
+    Rows for a prompt are buffered until every earlier prompt has been
+    written, so the output matches a sequential run.
+    """
+    def __init__(self, writer, start=0):
+        self.writer = writer
+        self.next_idx = start
+        self.pending = {}
+
+    def add(self, prompt_idx, rows):
+        self.pending[prompt_idx] = rows
+        while self.next_idx in self.pending:
+            self.writer.writerows(self.pending.pop(self.next_idx))
+            self.next_idx += 1
+
+    def flush(self):
+        """Write whatever is still buffered, in prompt-id order"""
+        for prompt_idx in sorted(self.pending):
+            self.writer.writerows(self.pending.pop(prompt_idx))
+
+
+class ResultsJournal:
+    """
+    Append-only journal of finished output rows, used to resume interrupted runs.
+
+    Each line is a JSON list [id, prompt, response]. `sync` flushes and
+    fsyncs the file, so a killed job loses at most the rows written since
+    the last sync. A partly written last line is cut off on load.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.file = None
+
+    def load(self):
+        """Read the ids of finished rows"""
+        if not os.path.exists(self.path):
+            return
+        good_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    break
+                self.completed.add(row[0])
+                good_bytes += len(line)
+        with open(self.path, "r+b") as f:
+            f.truncate(good_bytes)
+
+    def import_csv(self, path):
+        """Add the rows of an existing (possibly truncated) output CSV"""
+        # A file cut off mid-character only damages the last row, which is dropped
+        with open(path, newline="", errors="replace") as f:
+            complete = f.read().endswith('"\r\n')
+            f.seek(0)
+            rows = []
+            try:
+                for row in csv.reader(f):
+                    rows.append(row)
+            except csv.Error:
+                complete = False
+        # Skip the header, and the last row if the file was cut off mid-row
+        rows = [row for row in rows[1:(None if complete else -1)] if len(row) == 3]
+        self.write(rows)
+        self.sync()
+        logging.info(f"Imported {len(rows)} rows from {path}")
+
+    def write(self, rows):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        for row in rows:
+            self.file.write(json.dumps(row) + "\n")
+            self.completed.add(row[0])
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rows(self):
+        """Iterate over every journaled row"""
+        with open(self.path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class TokenIdWriter:
+    """
+    Compact binary output of the generated token ids.
+
+    Writes three files next to each other:
+      <prefix>.ids       flat int32 array of every generated token id
+      <prefix>.offsets   int64 array, entry i is where row i starts and entry i + 1 where it ends
+      <prefix>.meta.csv  one line of prompt_id,top_p,lambda per row
+    Rows are in the order they finish, not in prompt-id order. Use
+    `read_token_output` to memory-map them. When appending, rows that an
+    interrupted run left in only some of the files are cut off first.
+    """
+    def __init__(self, prefix, append=False):
+        self.prefix = prefix
+        self.end = self._truncate() if append else None
+        append = self.end is not None
+        mode = "ab" if append else "wb"
+        self.ids = open(f"{prefix}.ids", mode)
+        self.offsets = open(f"{prefix}.offsets", mode)
+        self.meta = open(f"{prefix}.meta.csv", "a" if append else "w")
+        if not append:
+            self.end = 0
+            np.zeros(1, dtype=np.int64).tofile(self.offsets)
+            self.meta.write("prompt_id,top_p,lambda\n")
+
+    def _truncate(self):
+        """
+        Cut the three files to the rows that are complete in all of them.
+
+        Returns the number of ids kept, or None if there is no output to append to.
+        """
+        paths = [f"{self.prefix}{suffix}" for suffix in (".ids", ".offsets", ".meta.csv")]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        ids_path, offsets_path, meta_path = paths
+        offsets = np.fromfile(offsets_path, dtype=np.int64, count=os.path.getsize(offsets_path) // 8)
+        with open(meta_path, "rb") as f:
+            meta_lines = f.read().splitlines(keepends=True)
+        if len(offsets) == 0 or not meta_lines or not meta_lines[0].endswith(b"\n"):
+            return None
+        # Skip the header and a partly written last line
+        num_meta = sum(line.endswith(b"\n") for line in meta_lines[1:])
+        num_rows = min(num_meta, len(offsets) - 1)
+        num_ids = os.path.getsize(ids_path) // 4
+        while offsets[num_rows] > num_ids:
+            num_rows -= 1
+        end = int(offsets[num_rows])
+        for path, size in ((ids_path, 4 * end), (offsets_path, 8 * (num_rows + 1)),
+                           (meta_path, sum(len(line) for line in meta_lines[:num_rows + 1]))):
+            if os.path.getsize(path) != size:
+                logging.info(f"Cutting {path} to {num_rows} complete rows")
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+        return end
+
+    def write(self, prompt_id, configs, sequences):
+        """Append one prompt's sequences, with a (top_p, lambda) config per sequence"""
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int32, count=int(lengths.sum())).tofile(self.ids)
+        (self.end + np.cumsum(lengths)).tofile(self.offsets)
+        self.end += int(lengths.sum())
+        self.meta.writelines(f"{prompt_id},{p},{lamb}\n" for p, lamb in configs)
+
+    def flush(self):
+        for f in (self.ids, self.offsets, self.meta):
+            f.flush()
+
+    def sync(self):
+        """Flush and fsync the three files"""
+        if self.ids.closed:
+            return
+        self.flush()
+        for f in (self.ids, self.offsets, self.meta):
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.sync()
+        for f in (self.ids, self.offsets, self.meta):
+            f.close()
+
+
+def read_token_output(prefix):
+    """
+    Memory-map a token-id output written by `TokenIdWriter`.
+
+    Returns (ids, offsets, meta) where row i is ids[offsets[i]:offsets[i + 1]]
+    and meta is a list of (prompt_id, top_p, lambda) tuples. A row that was
+    written more than once (e.g. by a resumed run) keeps its last copy.
+    """
+    # An empty file (e.g. from a shard with nothing left to generate) cannot be mapped
+    ids, offsets = (np.memmap(path, dtype=dtype, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=dtype)
+                    for path, dtype in ((f"{prefix}.ids", np.int32), (f"{prefix}.offsets", np.int64)))
+    with open(f"{prefix}.meta.csv") as f:
+        next(f)
+        meta = [(int(prompt_id), float(p), float(lamb)) for prompt_id, p, lamb in csv.reader(f)]
+    # Ignore a row cut off by an interrupted run
+    num_rows = min(len(meta), len(offsets) - 1)
+    meta = meta[:num_rows]
+    offsets = offsets[:num_rows + 1]
+    ids = ids[:offsets[-1]]
+    last = {key: row for row, key in enumerate(meta)}
+    if len(last) < num_rows:
+        keep = sorted(last.values())
+        starts = np.asarray(offsets[keep])
+        ends = np.asarray(offsets[[row + 1 for row in keep]])
+        ids = np.concatenate([ids[start:end] for start, end in zip(starts, ends)])
+        offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+        meta = [meta[row] for row in keep]
+    return ids, offsets, meta
+
+
+def merge_token_outputs(prefixes, prefix, append=False):
+    """
+    Concatenate several token-id outputs (e.g. one per shard) into `prefix` and remove them
+    """
+    writer = TokenIdWriter(prefix, append=append)
+    for part in prefixes:
+        ids, offsets, meta = read_token_output(part)
+        np.asarray(ids).tofile(writer.ids)
+        (writer.end + np.asarray(offsets[1:])).tofile(writer.offsets)
+        writer.end += len(ids)
+        writer.meta.writelines(f"{prompt_id},{p},{lamb}\n" for prompt_id, p, lamb in meta)
+        del ids, offsets
+        for suffix in (".ids", ".offsets", ".meta.csv"):
+            os.remove(f"{part}{suffix}")
+    writer.close()
+
+
+def token_output_shards(args):
+    """
+    Prefixes of the `<token-output>.shard<N>` outputs to merge: this run's
+    shards, or with --resume every one on disk, including ones left by a run
+    with a different --num-workers
+    """
+    if not args.resume:
+        prefixes = [f"{args.token_output}.shard{shard_idx}" for shard_idx in range(args.num_workers)]
+        return [prefix for prefix in prefixes if os.path.exists(f"{prefix}.offsets")]
+    return sorted(path[:-len(".offsets")] for path in glob.glob(f"{glob.escape(args.token_output)}.shard*.offsets"))
+
+
+def record_token_ids(outputs, token_writer, args):
+    """
+    Pass generated sequences through, writing their token ids to `token_writer`
+
+    Each prompt's ids are flushed before it is passed on, so they never reach
+    the disk after its journaled rows.
+    """
+    for prompt_id, generated_sequences in outputs:
+        token_writer.write(prompt_id, args.configs, generated_sequences)
+        token_writer.flush()
+        yield prompt_id, generated_sequences
+    token_writer.close()
+
+
+def load_tokenizer(args):
+    """Load the GPT-2 tokenizer, set up for left-padded batches"""
+    tokenizer = None
+    if not args.slow_tokenizer:
+        # Prefer the Rust-backed tokenizer when it can be built for this model
+        try:
+            tokenizer = GPT2TokenizerFast.from_pretrained(args.model_name_or_path)
+        except (ImportError, OSError, ValueError) as err:
+            logging.info(f"Fast tokenizer unavailable, using the Python tokenizer: {err}")
+    if tokenizer is None:
+        tokenizer = GPT2Tokenizer.from_pretrained(args.model_name_or_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"  # Hack to be able to batch generate
+    return tokenizer
+
+
+MMAP_INDEX = "mmap_index.json"
+MMAP_WEIGHTS = "mmap_weights.bin"
+
+
+def checkpoint_fingerprint(model_name_or_path):
+    """
+    Identify a checkpoint by its absolute path and the size and modification time of its files.
+
+    A model name that is not a local directory is identified by the name alone.
+    """
+    if not os.path.isdir(model_name_or_path):
+        return {"source": model_name_or_path}
+    source = os.path.abspath(model_name_or_path)
+    files = {}
+    for name in (WEIGHTS_NAME, CONFIG_NAME):
+        path = os.path.join(source, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    return {"source": source, "files": files}
+
+
+def mmap_index_matches(mmap_dir, model_name_or_path):
+    """Whether `mmap_dir` holds converted weights of this checkpoint, as it is now"""
+    index_path = os.path.join(mmap_dir, MMAP_INDEX)
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as f:
+        source = json.load(f).get("checkpoint")
+    if source != checkpoint_fingerprint(model_name_or_path):
+        logging.warning(f"{mmap_dir} holds the weights of {source['source'] if source else 'an unknown checkpoint'}, "
+                        f"not {model_name_or_path} as it is now. Converting again.")
+        return False
+    return True
+
+
+def convert_to_mmap(model_name_or_path, mmap_dir):
+    """
+    Convert a checkpoint to a flat weight file that can be memory-mapped.
+
+    Every tensor of the state dict is written once to `mmap_weights.bin`
+    (tied weights share one copy), with names, dtypes, shapes and byte
+    offsets in `mmap_index.json`, together with the checkpoint's
+    fingerprint. The model config is saved alongside. Both files are
+    replaced atomically, so processes still mapping an older conversion
+    keep their copy.
+    """
+    model = GPT2LMHeadModel.from_pretrained(model_name_or_path)
+    os.makedirs(mmap_dir, exist_ok=True)
+    model.config.save_pretrained(mmap_dir)
+
+    index = {}
+    written = {}
+    offset = 0
+    weights_path = os.path.join(mmap_dir, MMAP_WEIGHTS)
+    with open(f"{weights_path}.tmp", "wb") as f:
+        for name, tensor in model.state_dict().items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            key = (tensor.data_ptr(), tuple(tensor.shape))
+            if key not in written:
+                # Align every tensor to 64 bytes
+                f.write(b"\0" * (-offset % 64))
+                offset += -offset % 64
+                f.write(array.tobytes())
+                written[key] = offset
+                offset += array.nbytes
+            index[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": written[key]}
+    os.replace(f"{weights_path}.tmp", weights_path)
+    # Write the index last so a half-finished conversion is not picked up
+    index_path = os.path.join(mmap_dir, MMAP_INDEX)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"checkpoint": checkpoint_fingerprint(model_name_or_path), "tensors": index}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+    logging.info(f"Wrote memory-mappable weights for {model_name_or_path} to {mmap_dir}")
+
+
+@contextlib.contextmanager
+def skip_weight_init():
+    """Make module constructors skip the random initialization of their weights"""
+    patches = [(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+               for name in ("normal_", "uniform_", "kaiming_uniform_", "zeros_", "ones_", "constant_")]
+    patches += [(module, "reset_parameters", lambda self: None)
+                for module in (torch.nn.Linear, torch.nn.Embedding, torch.nn.LayerNorm)]
+    patches.append((GPT2PreTrainedModel, "_init_weights", lambda self, module: None))
+    saved = [(owner, name, owner.__dict__.get(name)) for owner, name, _ in patches]
+    for owner, name, replacement in patches:
+        setattr(owner, name, replacement)
+    try:
+        yield
+    finally:
+        for owner, name, original in saved:
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+
+def load_mmap_model(mmap_dir):
+    """
+    Build a GPT-2 model whose weights are read-only memory maps of `mmap_dir`.
+
+    Every process that maps the same file shares one copy of the weights in
+    the OS page cache, instead of holding its own copy.
+    """
+    with open(os.path.join(mmap_dir, MMAP_INDEX)) as f:
+        index = json.load(f)["tensors"]
+    # The random weights are never written, so their pages are never touched before they are swapped out
+    with skip_weight_init():
+        model = GPT2LMHeadModel(GPT2Config.from_pretrained(mmap_dir))
+    weights_path = os.path.join(mmap_dir, MMAP_WEIGHTS)
+    with warnings.catch_warnings():
+        # torch warns that the read-only maps are not writable
+        warnings.simplefilter("ignore", UserWarning)
+        for name, entry in index.items():
+            array = np.memmap(weights_path, dtype=np.dtype(entry["dtype"]), mode="r",
+                offset=entry["offset"], shape=tuple(entry["shape"]))
+            tensor = torch.from_numpy(array)
+            *path, attr = name.split(".")
+            module = model
+            for part in path:
+                module = getattr(module, part)
+            if attr in module._parameters:
+                module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[attr] = tensor
+    model.tie_weights()
+    return model
+
+
+def quantize_int8(model):
+    """
+    Dynamic int8 quantization of the model's linear layers.
+
+    GPT-2 stores its attention and MLP projections as `Conv1D` modules, which
+    `quantize_dynamic` does not handle, so they are first swapped for the
+    equivalent `nn.Linear` layers.
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                nx, nf = child.weight.shape
+                linear = torch.nn.Linear(nx, nf)
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+                linear.bias = torch.nn.Parameter(child.bias.detach().clone(), requires_grad=False)
+                setattr(module, name, linear)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_cache_path(args):
+    """
+    Where the quantized model is cached, or None to skip caching.
+
+    `<cache>.json` next to it records the checkpoint fingerprint and torch
+    version it was made from.
+    """
+    if args.quantize_cache:
+        return args.quantize_cache
+    if os.path.isdir(args.model_name_or_path):
+        return os.path.join(args.model_name_or_path, f"quantized_{args.quantize}.pt")
+    return None
+
+
+def load_fp32_model(args):
+    """Load the unquantized model, from the memory-mapped weights if requested"""
+    if args.mmap_weights:
+        return load_mmap_model(args.mmap_weights)
+    return GPT2LMHeadModel.from_pretrained(args.model_name_or_path)
+
+
+def load_model(args):
+    """Load the fine-tuned GPT-2 model onto `args.device`"""
+    if args.quantize:
+        cache_path = quantized_cache_path(args)
+        source = {"checkpoint": checkpoint_fingerprint(args.model_name_or_path), "torch": torch.__version__,
+                  "quantize": args.quantize, "format": "state_dict"}
+        cached_source = None
+        if cache_path and os.path.exists(cache_path) and os.path.exists(f"{cache_path}.json"):
+            with open(f"{cache_path}.json") as f:
+                cached_source = json.load(f)
+        if cached_source == source:
+            # Only the state dict is cached: a pickled module needs torch.load(weights_only=False) on newer torch
+            with skip_weight_init(), torch.no_grad():
+                model = GPT2LMHeadModel(GPT2Config.from_pretrained(args.model_name_or_path))
+                # Uninitialized memory may hold NaNs, which the quantization observers would see
+                for param in model.parameters():
+                    param.zero_()
+                model = quantize_int8(model.eval())
+            model.load_state_dict(torch.load(cache_path))
+        else:
+            if cache_path and os.path.exists(cache_path):
+                logging.warning(f"{cache_path} was made from another checkpoint or torch version. Quantizing again.")
+            model = quantize_int8(load_fp32_model(args).eval())
+            if cache_path:
+                torch.save(model.state_dict(), f"{cache_path}.tmp")
+                os.replace(f"{cache_path}.tmp", cache_path)
+                # Written last, so an interrupted save is never taken for a good cache
+                with open(f"{cache_path}.json", "w") as f:
+                    json.dump(source, f)
+                logging.info(f"Cached the quantized model at {cache_path}")
+    else:
+        model = load_fp32_model(args)
+    model.to(args.device)
+    model.eval()
+    return model
+
+
+def distinct_n(sequences, n):
+    """Distinct n-grams over a list of token id lists, divided by the total number of tokens"""
+    ngrams = set()
+    num_tokens = 0
+    for sequence in sequences:
+        num_tokens += len(sequence)
+        ngrams.update(zip(*[sequence[i:] for i in range(n)]))
+    return len(ngrams) / num_tokens if num_tokens else 0.0
+
+
+@torch.no_grad()
+def sequence_log_likelihood(model, prompts, continuations, pad_token_id, device):
+    """
+    Mean per-token log-likelihood of each continuation given its prompt
+    """
+    input_ids, attention_mask = pad_batch([p + c for p, c in zip(prompts, continuations)], pad_token_id)
+    input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    logits = model(input_ids, attention_mask=attention_mask, position_ids=position_ids)[0]
+    log_probs = torch.log_softmax(logits[:, :-1].float(), dim=-1).gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+    scores = []
+    for row, continuation in enumerate(continuations):
+        scores.append(log_probs[row, -len(continuation):].mean().item() if continuation else 0.0)
+    return scores
+
+
+def check_quantized(args, tokenizer):
+    """
+    Compare the int8 model against fp32 on a sample of prompts.
+
+    Both models decode the sample greedily. Logs decoding speed, distinct-1/2
+    of the generated token ids, and the mean per-token log-likelihood that
+    each model assigns to the fp32 continuations.
+    """
+    # Reservoir sample of --quantize-check prompts
+    rng = random.Random(args.seed)
+    sample = []
+    for i, prompt in enumerate(read_prompts(args.prompt_path)):
+        if len(sample) < args.quantize_check:
+            sample.append(prompt)
+        elif rng.random() < args.quantize_check / (i + 1):
+            sample[rng.randrange(args.quantize_check)] = prompt
+    prompts = encode_prompts(tokenizer, sample)
+    models = {"fp32": load_fp32_model(args).to(args.device).eval(), args.quantize: load_model(args)}
+
+    outputs = {}
+    for name, model in models.items():
+        decoder = FusedDecoder(model, [(0.0, 0.0)], args.length, tokenizer.eos_token_id, tokenizer.pad_token_id,
+            args.bsz, args.device)
+        generated = {idx: tokens for idx, _, tokens in decoder.decode(enumerate(prompts))}
+        outputs[name] = [generated[idx] for idx in range(len(prompts))]
+        logging.info(f"{name}: {decoder.stats.tokens_per_sec():.1f} tokens/sec, "
+                     f"distinct-1 {distinct_n(outputs[name], 1):.4f}, distinct-2 {distinct_n(outputs[name], 2):.4f}")
+    for name, model in models.items():
+        scores = []
+        for start in range(0, len(prompts), args.bsz):
+            scores.extend(sequence_log_likelihood(model, prompts[start:start + args.bsz],
+                outputs["fp32"][start:start + args.bsz], tokenizer.pad_token_id, args.device))
+        logging.info(f"{name}: mean per-token log-likelihood of the fp32 outputs {np.mean(scores):.4f}")
+    matches = sum(a == b for a, b in zip(outputs["fp32"], outputs[args.quantize]))
+    logging.info(f"{matches} of {len(prompts)} greedy outputs are identical")
+
+
+def journal_outputs(journal, outputs, tokenizer, args, prompt_lst, token_writer=None):
+    """
+    Decode generated sequences and append their rows to `journal`.
+
+    Rows already in the journal are skipped. The journal is synced once per
+    --bsz prompts, so an interrupted run loses at most one batch. The token
+    ids in `token_writer` are synced first, so journaled rows always have
+    their ids on disk.
+    """
+    for i, (prompt_id, generated_sequences) in enumerate(outputs):
+        start_time = time.time()
+        rows = []
+        for row_id, generated_sequence in zip(row_ids(args, prompt_id), generated_sequences):
+            if row_id not in journal.completed:
+                response = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
+                rows.append([row_id, prompt_lst[prompt_id], response])
+        decoded_time = time.time()
+        metrics.accumulate("detokenize", decoded_time - start_time, args.bsz, rows=len(rows))
+        journal.write(rows)
+        if (i + 1) % args.bsz == 0:
+            if token_writer is not None:
+                token_writer.sync()
+            journal.sync()
+        metrics.accumulate("write", time.time() - decoded_time, args.bsz, rows=len(rows))
+    journal.sync()
+    journal.close()
+    metrics.flush("detokenize")
+    metrics.flush("write")
+
+
+def merge_journals(journal_paths, output_path, num_prompts, args):
+    """
+    Write the journaled rows to the output CSV in prompt-id order and remove the journals
+    """
+    journaled = {}
+    for path in journal_paths:
+        for row in ResultsJournal(path).rows():
+            journaled[row[0]] = row
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["id", "prompt", "response"])
+        for prompt_id in range(num_prompts):
+            writer.writerows(journaled[row_id] for row_id in row_ids(args, prompt_id))
+    os.replace(tmp_path, output_path)
+    for path in journal_paths:
+        os.remove(path)
+
+
+def write_csv(outputs, tokenizer, args, prompt_lst):
+    """
+    Decode generated sequences and write them to --output-path in prompt-id order
+    """
+    with open(args.output_path, "w+", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["id", "prompt", "response"])
+        ordered_writer = OrderedRowWriter(writer)
+
+        for prompt_id, generated_sequences in outputs:
+            start_time = time.time()
+            rows = []
+            for row_id, generated_sequence in zip(row_ids(args, prompt_id), generated_sequences):
                 response = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-                
                 # Write upprocessed output
-                writer.writerow([f"{prompt_id}_{p}", prompt, response])
+                rows.append([row_id, prompt_lst[prompt_id], response])
+            decoded_time = time.time()
+            metrics.accumulate("detokenize", decoded_time - start_time, args.bsz, rows=len(rows))
+            # Rows are written in prompt-id order once all earlier prompts are done
+            ordered_writer.add(prompt_id, rows)
+            metrics.accumulate("write", time.time() - decoded_time, args.bsz, rows=len(rows))
+        ordered_writer.flush()
+    metrics.flush("detokenize")
+    metrics.flush("write")
+
+
+def write_outputs(outputs, tokenizer, args, prompt_lst, completed):
+    """
+    Write generated sequences straight to the CSV, or to the journal when resuming.
+
+    With --token-output the token ids are also written in binary form.
+    """
+    token_writer = None
+    if args.token_output:
+        token_writer = TokenIdWriter(args.token_output, append=args.resume)
+        outputs = record_token_ids(outputs, token_writer, args)
+    if args.resume:
+        journal = ResultsJournal(f"{args.output_path}.journal")
+        journal.load()
+        journal.completed |= completed
+        journal_outputs(journal, outputs, tokenizer, args, prompt_lst, token_writer)
+    else:
+        write_csv(outputs, tokenizer, args, prompt_lst)
+
+
+class _PipelineStop(Exception):
+    """Raised in a pipeline stage when another stage has failed"""
+
+
+_END = object()
+
+
+def _put(q, item, stop):
+    """Put `item` on a bounded queue, giving up if another stage failed"""
+    while True:
+        if stop.is_set():
+            raise _PipelineStop()
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _drain(q, stop):
+    """Iterate over a queue until the end marker"""
+    while True:
+        if stop.is_set():
+            raise _PipelineStop()
+        try:
+            item = q.get(timeout=1)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+
+def _pipeline_stage(fn, stop, errors):
+    """Run one stage of the pipeline, recording its error and stopping the other stages"""
+    def run():
+        try:
+            fn()
+        except _PipelineStop:
+            pass
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+    return run
+
 
-# Close file
-f.close()
+def stream_batches(args, tokenizer, prompt_texts, completed, counter):
+    """
+    Read, tokenize and schedule prompts one window at a time.
+
+    Reads --pipeline-window prompts, sorts them into length-bucketed batches
+    and yields lists of (prompt index, token ids). Token ids come from the
+    encoded-prompt cache when one exists. Otherwise, a run that encodes every
+    prompt saves them to the cache. The prompt text is kept
+    in `prompt_texts` until the writer is done with it, and `counter` holds
+    the number of prompts read so far.
+    """
+    cache = load_prompt_cache(args, tokenizer)
+    # A resumed run skips prompts, so it cannot fill the cache
+    cache_writer = None
+    if args.prompt_cache_dir and cache is None and not completed:
+        cache_writer = PromptCacheWriter(args, tokenizer)
+
+    def window_batches(window):
+        start_time = time.time()
+        if cache is not None:
+            encoded = [cached_prompt(cache, idx) for idx, _ in window]
+        else:
+            encoded = encode_prompts(tokenizer, [prompt for _, prompt in window])
+            if cache_writer is not None:
+                cache_writer.write(encoded)
+        metrics.record("tokenize", time.time() - start_time, prompts=len(window),
+            prompt_tokens=sum(len(ids) for ids in encoded))
+        for (idx, prompt), ids in zip(window, encoded):
+            prompt_texts[idx] = prompt
+        for batch in schedule_batches([len(ids) for ids in encoded], args.bsz, args.max_batch_tokens):
+            yield [(window[j][0], encoded[j]) for j in batch]
+
+    window = []
+    for idx, prompt in enumerate(read_prompts(args.prompt_path)):
+        counter[0] = idx + 1
+        if completed and all(row_id in completed for row_id in row_ids(args, idx)):
+            continue
+        window.append((idx, prompt))
+        if len(window) == args.pipeline_window:
+            yield from window_batches(window)
+            window = []
+    if window:
+        yield from window_batches(window)
+    if cache_writer is not None:
+        cache_writer.close()
+
+
+def run_pipeline(args, model, tokenizer, completed):
+    """
+    Generate with tokenization, model compute and writing in separate threads.
+
+    A reader thread streams, tokenizes and batches the prompts into a bounded
+    queue, this thread only runs the model, and a writer thread decodes the
+    outputs and writes them. Returns the number of prompts read.
+    """
+    batch_queue = queue.Queue(maxsize=args.queue_size)
+    output_queue = queue.Queue(maxsize=args.queue_size * args.bsz)
+    stop = threading.Event()
+    errors = []
+    prompt_texts = {}
+    counter = [0]
+
+    def read():
+        for batch in stream_batches(args, tokenizer, prompt_texts, completed, counter):
+            _put(batch_queue, batch, stop)
+        _put(batch_queue, _END, stop)
+
+    def released_outputs():
+        # The prompt text is no longer needed once its rows are built
+        for prompt_id, generated_sequences in _drain(output_queue, stop):
+            yield prompt_id, generated_sequences
+            del prompt_texts[prompt_id]
+
+    def write():
+        write_outputs(released_outputs(), tokenizer, args, prompt_texts, completed)
+
+    def compute():
+        generate = generate_fused if args.decoder == "fused" else generate_hf
+        for output in generate(model, tokenizer, args, _drain(batch_queue, stop)):
+            _put(output_queue, output, stop)
+        _put(output_queue, _END, stop)
+
+    threads = [threading.Thread(target=_pipeline_stage(fn, stop, errors), daemon=True) for fn in (read, write)]
+    for thread in threads:
+        thread.start()
+    _pipeline_stage(compute, stop, errors)()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return counter[0]
+
+
+def partition_prompts(prompt_indices, costs, num_shards):
+    """
+    Split prompts into `num_shards` groups with about the same total cost.
+
+    Greedy longest-first assignment: each prompt goes to the shard with the
+    smallest total so far. Each shard keeps its prompts in input order.
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0, shard) for shard in range(num_shards)]
+    for idx in sorted(prompt_indices, key=lambda i: -costs[i]):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(idx)
+        heapq.heappush(loads, (load + costs[idx], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def shard_worker(args, shard_idx, prompt_indices, prompt_lst, encoded_prompts, cpus, completed):
+    """
+    Generate one shard of the prompts in a separate process.
+
+    The process is pinned to `cpus` with one torch thread per CPU, loads its
+    own model copy and journals its rows to `<output-path>.journal.<shard>`
+    (and its token ids to `<token-output>.shard<shard>`).
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(max(len(cpus), 1))
+    metrics.open(args.metrics_path, shard=shard_idx)
+    if args.profile_batches:
+        profile_path = args.profile_path or f"{args.output_path}.trace.json"
+        args.profile_path = f"{profile_path}.shard{shard_idx}"
+    tokenizer = load_tokenizer(args)
+    model = load_model(args)
 
+    shard_lengths = [len(encoded_prompts[idx]) for idx in prompt_indices]
+    batches = [[prompt_indices[j] for j in batch]
+        for batch in schedule_batches(shard_lengths, args.bsz, args.max_batch_tokens)]
+    logging.info(f"Shard {shard_idx}: {len(prompt_indices)} prompts on CPUs {sorted(cpus)}")
 
+    journal = ResultsJournal(f"{args.output_path}.journal.{shard_idx}")
+    journal.load()
+    journal.completed |= completed
+    generate = generate_fused if args.decoder == "fused" else generate_hf
+    batches = ([(idx, encoded_prompts[idx]) for idx in batch] for batch in batches)
+    outputs = generate(model, tokenizer, args, batches)
+    token_writer = None
+    if args.token_output:
+        token_writer = TokenIdWriter(f"{args.token_output}.shard{shard_idx}", append=args.resume)
+        outputs = record_token_ids(outputs, token_writer, args)
+    journal_outputs(journal, outputs, tokenizer, args, prompt_lst, token_writer)
+
+
+def run_shards(args, remaining, prompt_lst, encoded_prompts, completed):
+    """
+    Split the remaining prompts by token count and generate them in --num-workers processes
+    """
+    costs = [len(ids) + args.length for ids in encoded_prompts]
+    shards = partition_prompts(remaining, costs, args.num_workers)
+    if hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count()))
+    threads = args.threads_per_worker or max(len(available) // args.num_workers, 1)
+
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for shard_idx, prompt_indices in enumerate(shards):
+        cpus = set(available[(shard_idx * threads) % len(available):][:threads])
+        worker = context.Process(target=shard_worker,
+            args=(args, shard_idx, prompt_indices, prompt_lst, encoded_prompts, cpus, completed))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    failed = [shard_idx for shard_idx, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        logging.error(f"Shards {failed} failed. Rerun with --resume to finish the remaining prompts.")
+        sys.exit(1)
+
+
+def run_batched(args, tokenizer, completed):
+    """
+    Generate for the whole prompt file, loaded and tokenized up front
+    """
+    # Load and tokenize the prompts, then group them by length for quicker generation
+    logging.info(f"Loading prompts from {args.prompt_path}")
+    prompt_lst = list(read_prompts(args.prompt_path))
+    logging.info("total number of sentences = {}".format(len(prompt_lst)))
+    start_time = time.time()
+    encoded_prompts = load_or_encode_prompts(args, tokenizer, prompt_lst)
+    prompt_lengths = [len(ids) for ids in encoded_prompts]
+    metrics.record("tokenize", time.time() - start_time, prompts=len(prompt_lst), prompt_tokens=sum(prompt_lengths))
+    remaining = [idx for idx in range(len(prompt_lst)) if any(row_id not in completed for row_id in row_ids(args, idx))]
+    if args.resume:
+        logging.info(f"Resuming with {len(remaining)} of {len(prompt_lst)} prompts left")
+
+    if args.num_workers > 1:
+        # Each worker journals its shard, then the journals are merged into one CSV
+        run_shards(args, remaining, prompt_lst, encoded_prompts, completed)
+        merge_journals(glob.glob(f"{glob.escape(args.output_path)}.journal*"), args.output_path, len(prompt_lst), args)
+        if args.token_output:
+            merge_token_outputs(token_output_shards(args), args.token_output, append=args.resume)
+    else:
+        batches = [[remaining[j] for j in batch]
+            for batch in schedule_batches([prompt_lengths[idx] for idx in remaining], args.bsz, args.max_batch_tokens)]
+        logging.info("total batch size = {}".format(len(batches)))
+        file_order = [remaining[i:i + args.bsz] for i in range(0, len(remaining), args.bsz)]
+        logging.info(f"Padding waste: {padding_waste(prompt_lengths, batches):.3f} "
+                     f"(file order: {padding_waste(prompt_lengths, file_order):.3f})")
+
+        model = load_model(args)
+        generate = generate_fused if args.decoder == "fused" else generate_hf
+        outputs = generate(model, tokenizer, args, ([(idx, encoded_prompts[idx]) for idx in batch] for batch in batches))
+        write_outputs(outputs, tokenizer, args, prompt_lst, completed)
+        if args.resume and args.token_output:
+            merge_token_outputs(token_output_shards(args), args.token_output, append=True)
+        if args.resume:
+            merge_journals(glob.glob(f"{glob.escape(args.output_path)}.journal*"), args.output_path, len(prompt_lst), args)
+
+
+def parse_args(argv=None):
+    """Process commandline arguments (`argv` defaults to sys.argv)"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt-path", type=str, default="/home/aadelucia/gpt/writing_prompts/test.wp.src",
+        help="Path to prompts, delineated by newlines")
+    parser.add_argument("--output-path", type=str, default="output.csv", 
+        help="Output path for generated repsonses in CSV format with columns <id>,<prompt>,<response>")
+    parser.add_argument("--model-name-or-path", type=str, default=None, help="Path to model")
+    parser.add_argument("--top-p", type=float, nargs="+", default=[0.0, 0.3, 0.5, 0.7, 0.9, 0.95, 1.0], 
+        help="Top-p (nucleus sampling) values to test. Can pass more than one value. Default values were used in the paper.")
+    parser.add_argument("--lambdas", type=float, nargs="+", default=None,
+        help="MMI anti-LM weights. Every --top-p value is decoded with every lambda in one expanded batch "
+             "(requires --decoder fused). Output ids become <prompt id>_<top-p>_<lambda>.")
+    parser.add_argument("--antilm-cache-mb", type=float, default=1024,
+        help="Memory budget of the cache of unconditional anti-LM results, shared by all prompts and lambdas "
+             "of the run. 0 disables it.")
+    parser.add_argument("--temperature", type=float, default=1.0,
+        help="Softmax temperature for the sampled (top-p > 0) responses")
+    parser.add_argument("--length", type=int, default=200, help="Maximum length of response (not including prompt length)")
+    parser.add_argument("--bsz", type=int, default=20, help="Batch size")
+    parser.add_argument("--max-batch-tokens", type=int, default=None,
+        help="Maximum padded prompt tokens (prompts x longest prompt) per batch. Batches are also capped at --bsz prompts.")
+    parser.add_argument("--decoder", choices=["generate", "fused"], default="generate",
+        help="'generate' calls model.generate once per top-p value. 'fused' runs the prompt prefill once and decodes "
+             "every top-p value together, dropping finished rows and refilling the batch with waiting prompts.")
+    parser.add_argument("--resume", action="store_true",
+        help="Journal finished rows next to --output-path and skip prompts that are already done. "
+             "Pass it on every run of a job that may be restarted.")
+    parser.add_argument("--num-workers", type=int, default=1,
+        help="Number of generation processes. Prompts are split between them by token count and each loads its own model copy.")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+        help="Torch threads (and pinned CPUs) per worker. Defaults to the available CPUs divided by --num-workers.")
+    parser.add_argument("--mmap-weights", type=str, default=None,
+        help="Directory of memory-mappable weights for --model-name-or-path. It is created on first use, and "
+             "later processes map the weights read-only so they share one copy in the page cache.")
+    parser.add_argument("--quantize", choices=["int8"], default=None,
+        help="Dynamically quantize the linear layers (CPU only). The quantized model is cached on disk.")
+    parser.add_argument("--quantize-cache", type=str, default=None,
+        help="Path of the cached quantized model. Defaults to quantized_<type>.pt in the model directory.")
+    parser.add_argument("--quantize-check", type=int, default=0,
+        help="Before generating, compare the quantized model against fp32 on this many prompts")
+    parser.add_argument("--pipeline", action="store_true",
+        help="Stream the prompt file and overlap tokenization, model compute and decoding/writing in separate threads")
+    parser.add_argument("--pipeline-window", type=int, default=1000,
+        help="Prompts read and length-sorted at a time in --pipeline mode")
+    parser.add_argument("--queue-size", type=int, default=4, help="Batches buffered between pipeline stages")
+    parser.add_argument("--slow-tokenizer", action="store_true",
+        help="Use the Python GPT2Tokenizer even if the fast (Rust) tokenizer is available")
+    parser.add_argument("--prompt-cache-dir", type=str, default=None,
+        help="Directory for encoded prompts, keyed by the prompt file and tokenizer hashes. Later runs load the token ids instead of tokenizing.")
+    parser.add_argument("--token-output", type=str, default=None,
+        help="Also write the generated token ids as <prefix>.ids/.offsets/.meta.csv binary files that can be memory-mapped")
+    parser.add_argument("--display-progress", type=int, default=100, help="How often to print the generation progress")
+    
+    parser.add_argument("--metrics-path", type=str, default=None,
+        help="Append per-stage timings (tokenize, prefill, decode, detokenize, write) with token counts, "
+             "padding and peak memory to this JSON-lines file.")
+    parser.add_argument("--profile-batches", type=int, nargs=2, default=None, metavar=("START", "END"),
+        help="Run the torch profiler over batches START to END (inclusive) and save a Chrome trace.")
+    parser.add_argument("--profile-path", type=str, default=None,
+        help="Where to save the --profile-batches trace (default: <output-path>.trace.json)")
+    parser.add_argument("--seed", type=int, default=42,
+        help="Random seed. With --decoder fused, each (prompt, top-p, lambda) row samples from its own stream "
+             "derived from it. --decoder generate seeds each batch and top-p value.")
+    parser.add_argument("--no-cuda", action="store_true", help="Avoid using CUDA even if available")
+
+    args = parser.parse_args(argv)
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.temperature <= 0.0:
+        parser.error("--temperature must be positive, use --top-p 0.0 for greedy decoding")
+    if args.lambdas and args.decoder != "fused":
+        parser.error("--lambdas requires --decoder fused")
+    args.configs = [(p, lamb) for p in args.top_p for lamb in (args.lambdas or [0.0])]
+    if args.quantize and args.device.type != "cpu":
+        parser.error("--quantize only runs on CPU, pass --no-cuda")
+    if args.pipeline and args.num_workers > 1:
+        parser.error("--pipeline runs in a single process and cannot be combined with --num-workers")
+    rebatched = args.num_workers > 1 or args.resume or args.pipeline or args.max_batch_tokens
+    if args.decoder == "generate" and any(p > 0.0 for p in args.top_p) and rebatched:
+        logging.warning("--decoder generate samples per batch, so with --num-workers, --resume, --pipeline or "
+                        "--max-batch-tokens the sampled responses depend on how the prompts were batched. "
+                        "Use --decoder fused for samples that do not.")
+    return args
+
+
+def main(args):
+    """Generate responses for the prompt file, as configured by `args`"""
+    # Claim the GPU (research cluster-specific issue)
+    try:
+        torch.ones(1).to(args.device)
+    except RuntimeError as err:
+        logging.error(err)
+        sys.exit(1)
+
+    metrics.open(args.metrics_path)
+
+    # Load pre-trained OpenAI GPT-2 model
+    tokenizer = load_tokenizer(args)
+
+    # Skip the prompts that a previous run already finished
+    journal_paths = glob.glob(f"{glob.escape(args.output_path)}.journal*")
+    completed = set()
+    if args.resume:
+        for path in journal_paths:
+            journal = ResultsJournal(path)
+            journal.load()
+            completed |= journal.completed
+        if not completed and os.path.exists(args.output_path):
+            journal = ResultsJournal(f"{args.output_path}.journal")
+            journal.import_csv(args.output_path)
+            journal.close()
+            completed = journal.completed
+    else:
+        # Journals and token-id outputs from an earlier run would be merged into this one
+        for path in journal_paths:
+            os.remove(path)
+        if args.token_output:
+            for path in glob.glob(f"{glob.escape(args.token_output)}.shard*"):
+                os.remove(path)
+            for suffix in (".ids", ".offsets", ".meta.csv"):
+                if os.path.exists(f"{args.token_output}{suffix}"):
+                    os.remove(f"{args.token_output}{suffix}")
+
+    # Convert the checkpoint once, before any worker maps it
+    if args.mmap_weights and not mmap_index_matches(args.mmap_weights, args.model_name_or_path):
+        convert_to_mmap(args.model_name_or_path, args.mmap_weights)
+
+    # Quantize once and cache it for the workers, optionally checking quality against fp32
+    if args.quantize_check and args.quantize:
+        check_quantized(args, tokenizer)
+    elif args.quantize and args.num_workers > 1:
+        load_model(args)
+
+    if args.pipeline:
+        # Prompts are streamed, so the file is never held in memory
+        logging.info(f"Streaming prompts from {args.prompt_path}")
+        num_prompts = run_pipeline(args, load_model(args), tokenizer, completed)
+        logging.info("total number of sentences = {}".format(num_prompts))
+        if args.resume:
+            merge_journals(glob.glob(f"{glob.escape(args.output_path)}.journal*"), args.output_path, num_prompts, args)
+    else:
+        run_batched(args, tokenizer, completed)
+    metrics.close()
+
+
+if __name__ == "__main__":
+    # Load training parameters
+    main(parse_args())
@@ -11,7 +11,7 @@
 
 # Activate dev environments and call programs
 #eval "$(/home/lisali/anaconda3/bin/conda shell.bash hook)"
-source /home/aadelucia/miniconda3/bin/activate gpt-antilm
+source /home/aadelucia/miniconda3/bin/activate gpt
 export LD_LIBRARY_PATH=:/opt/NVIDIA/cuda-10/lib64/
 export CUDA_VISIBLE_DEVICES=$(free-gpu)
 
@@ -32,14 +32,15 @@ max_length=${MAX_LENGTH[$i]}
 OUTPUT_FILE="${OUTPUT_FILE_BASE}_${dataset}.csv"
 
 echo "Generating for response length $dataset on GPU ${CUDA_VISIBLE_DEVICES}"
-python $PROJECT_HOME/code/generate_batch_padded_antilm.py \
+python $PROJECT_HOME/code/generate_responses.py \
     --prompt-path ${TEST_PROMPTS} \
     --model-name-or-path "${MODEL_BASE}_${dataset}" \
     --output-path "${OUTPUT_FILE}" \
     --length "${max_length}" \
     --bsz "${BATCH_SIZE}" \
+    --decoder fused \
     --lambdas 0.1 0.2 0.35 0.5 \
-    --p 0.7
+    --top-p 0.7
 
 # Check exit status
 status=$?
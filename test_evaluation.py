@@ -0,0 +1,151 @@
+"""
+Tests for evaluation.py: the rewritten response cleaning and distinct-n give
+exactly the output of the original implementations, and entropy and self-BLEU
+that of straightforward ones, which are kept here as references.
+
+Run with `python -m pytest test_evaluation.py`.
+"""
+# Standard imports
+import math
+import random
+import collections
+
+# Third-party imports
+import numpy as np
+import pytest
+import regex
+from nltk.translate.bleu_score import SmoothingFunction, sentence_bleu
+
+# Local imports
+import evaluation
+
+
+def clean_response_reference(response):
+    """The original clean_response"""
+    # Remove extra characters
+    response = response.strip()
+    # Remove special tokens
+    response = regex.sub(r"<\|endoftext\|>|<newline>|\[RESPONSE\]", "", response)
+    # Lowercase
+    response = response.lower()
+    # Add spaces in front of punctuation
+    response = regex.sub(r"(\p{P})", r" \1", response)
+    # Remove excess spacing
+    response = regex.sub(r"\s+", " ", response)
+    return response
+
+
+def distinct_1(lines):
+    '''
+    Computes the number of distinct words divided by the total number of words.
+    Input:
+    lines: List of strings.
+
+    Written by Joao Sedoc
+    '''
+    words = ' '.join(lines).split(' ')
+    num_distinct_words = len(set(words))
+    return float(num_distinct_words) / len(words)
+
+
+def distinct_2(lines):
+    '''Computes the number of distinct bigrams divided by the total number of words.
+
+    Input:
+    lines: List of strings.
+
+    Written by Joao Sedoc
+    '''
+    all_bigrams = []
+    num_words = 0
+
+    for line in lines:
+        line_list = line.split(' ')
+        num_words += len(line_list)
+        bigrams = zip(line_list, line_list[1:])
+        all_bigrams.extend(list(bigrams))
+
+    return len(set(all_bigrams)) / float(num_words)
+
+
+def entropy_reference(lines, n):
+    """Entropy, in nats, of the frequencies of the n-grams of `lines`, counted with a Counter"""
+    counts = collections.Counter(tuple(words[i:i + n]) for words in (line.split(" ") for line in lines)
+                                 for i in range(len(words) - n + 1))
+    total = sum(counts.values())
+    return -sum(count / total * math.log(count / total) for count in counts.values())
+
+
+def self_bleu_reference(lines, max_n=4):
+    """Texygen's self-BLEU: the mean nltk sentence_bleu of each line against all the others"""
+    weights = tuple(1.0 / max_n for _ in range(max_n))
+    smoothing = SmoothingFunction().method1
+    lines = [line.split(" ") for line in lines]
+    return float(np.mean([sentence_bleu(lines[:i] + lines[i + 1:], line, weights, smoothing_function=smoothing)
+                          for i, line in enumerate(lines)]))
+
+
+# Pieces of the random test strings: special tokens and their fragments, case
+# and width changing letters, punctuation, every kind of whitespace and the
+# batch separator
+ATOMS = ["<|endoftext|>", "<newline>", "[RESPONSE]", "[Response]", "<new", "line>", "<|", "|>", "[", "]",
+         "ΟΔΟΣ", "Σ", "'", "’", "İ", "ß", "ﬁ", "\x1c", "\x1f", "\x85", "\xa0", " ", "　", " ", "  ",
+         "\t", "\n", "\r\n", ".", ",", "!?", "—", "«", "»", "_", "-", "@", "#", "%", "&", "*", "$", "+", "=",
+         "^", "`", "~", "|", "Hello", "WORLD", "a", "1", "é", "́", "🙂", "​", "\x00"]
+
+
+def random_responses(num_responses, seed):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(ATOMS) for _ in range(rng.randint(0, 12))) for _ in range(num_responses)]
+
+
+def random_lines(num_lines, vocab_size, seed):
+    """Lines of words from a small vocabulary, so they share many n-grams"""
+    rng = random.Random(seed)
+    return [" ".join(f"w{rng.randrange(vocab_size)}" for _ in range(rng.randint(1, 12))) for _ in range(num_lines)]
+
+
+def test_clean_response_matches_original():
+    for response in random_responses(200000, seed=0):
+        assert evaluation.clean_response(response) == clean_response_reference(response), repr(response)
+
+
+def test_clean_responses_matches_original():
+    responses = random_responses(20000, seed=1)
+    expected = [clean_response_reference(response) for response in responses]
+    # With the batch separator in some responses, and without it
+    assert evaluation.clean_responses(responses) == expected
+    responses = [response.replace(evaluation.BATCH_SEPARATOR, "") for response in responses]
+    assert evaluation.clean_responses(responses) == [clean_response_reference(response) for response in responses]
+
+
+def test_distinct_ngrams_matches_original():
+    # Cleaned responses, so with empty words and empty lines as well
+    lines = evaluation.clean_responses(random_responses(5000, seed=2))
+    for chunk_size in (1, 7, 1000, len(lines)):
+        counter = evaluation.DistinctNgrams(max_n=2)
+        for start in range(0, len(lines), chunk_size):
+            counter.update(lines[start:start + chunk_size])
+        assert counter.distinct(1) == distinct_1(lines)
+        assert counter.distinct(2) == distinct_2(lines)
+
+
+def test_entropy_matches_reference():
+    # Words from a small vocabulary, and cleaned responses with empty words and lines
+    for lines in (random_lines(300, 20, seed=3), evaluation.clean_responses(random_responses(3000, seed=4))):
+        counter = evaluation.DistinctNgrams(max_n=4, counts=True)
+        for start in range(0, len(lines), 70):
+            counter.update(lines[start:start + 70])
+        for n in range(1, 5):
+            assert counter.entropy(n) == pytest.approx(entropy_reference(lines, n), rel=1e-12)
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_self_bleu_matches_nltk():
+    rng = random.Random(5)
+    for seed in range(30):
+        lines = random_lines(rng.randint(2, 25), rng.randint(3, 40), seed)
+        for max_n in (2, 4):
+            assert evaluation.self_bleu(lines, max_n) == pytest.approx(self_bleu_reference(lines, max_n), rel=1e-12)
+    lines = evaluation.clean_responses(random_responses(200, seed=6))
+    assert evaluation.self_bleu(lines) == pytest.approx(self_bleu_reference(lines), rel=1e-12)
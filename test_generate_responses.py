@@ -0,0 +1,202 @@
+"""
+Tests for generate_responses.py on the small random GPT-2 of benchmark_generation.py.
+
+Run with `python -m pytest test_generate_responses.py`.
+"""
+# Standard imports
+import argparse
+import os
+import random
+
+# Third-party imports
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+# Local imports
+import benchmark_generation
+import generate_responses
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp("model"))
+    benchmark_generation.build_model(model_dir, argparse.Namespace(seed=0, n_embd=32, n_layer=2, n_head=2))
+    return model_dir
+
+
+@pytest.fixture(scope="module")
+def small_vocab_model():
+    """Random GPT-2 with 12 tokens, so responses share prefixes and often end with end-of-text (token 0)"""
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=12, n_positions=64, n_ctx=64, n_embd=32, n_layer=2, n_head=2,
+                        bos_token_id=0, eos_token_id=0)
+    return GPT2LMHeadModel(config).eval()
+
+
+def random_prompts(num_prompts, vocab_size, seed):
+    rng = random.Random(seed)
+    return [[rng.randint(1, vocab_size - 1) for _ in range(rng.randint(1, 12))] for _ in range(num_prompts)]
+
+
+def decode_reference(model, prompt, length, eos_token_id, lamb=0.0):
+    """
+    Greedy decoding of one prompt without a KV cache. With `lamb`, the MMI
+    anti-LM objective, whose unconditional model sees end-of-text and the response.
+    """
+    response = []
+    with torch.no_grad():
+        for _ in range(length):
+            scores = torch.log_softmax(model(torch.tensor([prompt + response]))[0][0, -1], -1)
+            if lamb:
+                unconditional = model(torch.tensor([[eos_token_id] + response]))[0][0, -1]
+                scores = scores - lamb * torch.log_softmax(unconditional, -1)
+            token = int(scores.argmax())
+            response.append(token)
+            if token == eos_token_id:
+                break
+    return response
+
+
+def fused_decode(model, prompts, configs, max_rows, antilm_cache_bytes=0):
+    decoder = generate_responses.FusedDecoder(model, configs, 20, 0, 0, max_rows, torch.device("cpu"),
+                                              antilm_cache_bytes=antilm_cache_bytes)
+    with torch.no_grad():
+        responses = {(prompt_id, config_idx): tokens
+                     for prompt_id, config_idx, tokens in decoder.decode(enumerate(prompts))}
+    return responses, decoder
+
+
+def active_rows(row_ids, width, paired=False):
+    """
+    _ActiveRows over `width` cache positions, whose logits and KV cache hold
+    each row's id (its id + 100 for its unconditional row)
+    """
+    values = torch.tensor(row_ids + [row_id + 100 for row_id in row_ids] if paired else row_ids, dtype=torch.float)
+    past = tuple(values.view(1, -1, 1, 1, 1).repeat(2, 1, 2, width, 3) for _ in range(2))
+    num_rows = len(row_ids)
+    return generate_responses._ActiveRows(list(row_ids), values.view(-1, 1).repeat(1, 5), past,
+                                          torch.ones(len(values), width), values.clone(), torch.zeros(num_rows),
+                                          torch.ones(num_rows), values[:num_rows].clone(), paired=paired)
+
+
+def check_active_rows(rows, widths, paired):
+    """Every row's tensors hold its own id, right-aligned to its number of `widths` cache positions"""
+    row_ids = rows.meta
+    values = row_ids + [row_id + 100 for row_id in row_ids] if paired else row_ids
+    width = max(widths[row_id] for row_id in row_ids)
+    assert rows.attention_mask.shape == (len(values), width)
+    assert rows.logits[:, 0].tolist() == values
+    assert rows.positions.tolist() == values
+    assert rows.lambdas.tolist() == row_ids
+    assert len(rows.top_p) == len(rows.temperature) == len(rows.tokens) == len(row_ids)
+    for j, value in enumerate(values):
+        row_width = widths[value % 100]
+        assert rows.attention_mask[j].tolist() == [0] * (width - row_width) + [1] * row_width
+        for layer in rows.past:
+            assert layer[:, j, :, :, :].shape[-2] == width
+            assert layer[:, j, 0, :, 0].tolist() == [[0] * (width - row_width) + [value] * row_width] * 2
+
+
+def generate_args(model_dir, tmp_path, *argv, output_name="output.csv"):
+    return generate_responses.parse_args([
+        "--prompt-path", os.path.join(tmp_path, "prompts.txt"),
+        "--model-name-or-path", model_dir,
+        "--output-path", os.path.join(tmp_path, output_name),
+        "--no-cuda",
+    ] + list(argv))
+
+
+def test_quantized_cache_reloads(model_dir, tmp_path):
+    args = generate_args(model_dir, tmp_path, "--quantize", "int8",
+                         "--quantize-cache", os.path.join(tmp_path, "quantized_int8.pt"))
+    input_ids = torch.randint(0, 256, (2, 7), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        expected = generate_responses.load_model(args)(input_ids)[0]
+        # The first load quantized and saved the model; later ones rebuild it from the cache
+        assert os.path.exists(args.quantize_cache)
+        for _ in range(2):
+            assert torch.equal(generate_responses.load_model(args)(input_ids)[0], expected)
+
+
+@pytest.mark.parametrize("paired", [False, True])
+def test_active_rows_select_extend(paired):
+    widths = {0: 3, 1: 3, 2: 3, 3: 5, 4: 5}
+    rows = active_rows([0, 1, 2], 3, paired)
+    rows.extend(active_rows([3, 4], 5, paired))
+    check_active_rows(rows, widths, paired)
+    rows.select([4, 0, 2])
+    assert rows.meta == [4, 0, 2]
+    check_active_rows(rows, widths, paired)
+    # Without the longer row, its left padding is dropped
+    rows.select([1, 2])
+    assert rows.meta == [0, 2]
+    check_active_rows(rows, widths, paired)
+
+
+@pytest.mark.parametrize("max_rows", [3, 64])
+def test_fused_greedy_matches_reference(small_vocab_model, max_rows):
+    prompts = random_prompts(13, 12, seed=1)
+    responses, _ = fused_decode(small_vocab_model, prompts, [(0.0, 0.0), (0.9, 0.0)], max_rows)
+    for prompt_id, prompt in enumerate(prompts):
+        assert responses[(prompt_id, 0)] == decode_reference(small_vocab_model, prompt, 20, 0)
+        assert 0 < len(responses[(prompt_id, 1)]) <= 20
+
+
+def test_fused_antilm_matches_reference(small_vocab_model):
+    prompts = random_prompts(11, 12, seed=3)
+    configs = [(0.0, 0.0), (0.0, 0.3), (0.0, 0.7), (0.9, 0.5)]
+    responses, _ = fused_decode(small_vocab_model, prompts, configs, 9)
+    for prompt_id, prompt in enumerate(prompts):
+        for config_idx, (top_p, lamb) in enumerate(configs[:3]):
+            assert responses[(prompt_id, config_idx)] == decode_reference(small_vocab_model, prompt, 20, 0, lamb)
+
+
+@pytest.mark.parametrize("cache_bytes", [10**9, 20000, 3000])
+def test_prefix_cache_matches_uncached(small_vocab_model, cache_bytes):
+    prompts = random_prompts(30, 12, seed=3)
+    configs = [(0.0, 0.0), (0.0, 0.3), (0.0, 0.7), (0.9, 0.5)]
+    torch.manual_seed(0)
+    expected, _ = fused_decode(small_vocab_model, prompts, configs, 9)
+    torch.manual_seed(0)
+    responses, decoder = fused_decode(small_vocab_model, prompts, configs, 9, antilm_cache_bytes=cache_bytes)
+    # Sampled rows draw from per-row seeded streams, so they match as well
+    assert responses == expected
+    assert decoder.cache.hits > 0
+    assert decoder.cache.num_bytes <= cache_bytes
+    if cache_bytes < 10**9:
+        assert decoder.cache.evictions > 0
+
+
+def run_generate(model_dir, tmp_path, output_name, *argv):
+    args = generate_args(model_dir, tmp_path, "--length", "8", "--bsz", "4", "--top-p", "0.0", "0.9",
+                         "--decoder", "fused", *argv, output_name=output_name)
+    generate_responses.main(args)
+    with open(args.output_path, "rb") as f:
+        return f.read()
+
+
+def test_resume_and_shards_match_single_run(model_dir, tmp_path):
+    benchmark_generation.write_prompts(os.path.join(tmp_path, "prompts.txt"), 12, seed=0)
+    expected = run_generate(model_dir, tmp_path, "single.csv")
+    assert run_generate(model_dir, tmp_path, "sharded.csv", "--num-workers", "2") == expected
+    # A run killed partway through a row, resumed with and without sharding
+    for name, argv in (("resumed.csv", []), ("resumed_sharded.csv", ["--num-workers", "2"])):
+        with open(os.path.join(tmp_path, name), "wb") as f:
+            f.write(expected[:len(expected) // 2])
+        assert run_generate(model_dir, tmp_path, name, "--resume", *argv) == expected
+
+
+def test_pipeline_fills_prompt_cache(model_dir, tmp_path):
+    benchmark_generation.write_prompts(os.path.join(tmp_path, "prompts.txt"), 12, seed=1)
+    cache_argv = ["--pipeline", "--pipeline-window", "5", "--prompt-cache-dir", os.path.join(tmp_path, "cache")]
+    expected = run_generate(model_dir, tmp_path, "first.csv", *cache_argv)
+    args = generate_args(model_dir, tmp_path, *cache_argv)
+    tokenizer = generate_responses.load_tokenizer(args)
+    cache = generate_responses.load_prompt_cache(args, tokenizer)
+    prompts = list(generate_responses.read_prompts(args.prompt_path))
+    assert [generate_responses.cached_prompt(cache, idx) for idx in range(len(prompts))] == \
+        generate_responses.encode_prompts(tokenizer, prompts)
+    assert not [name for name in os.listdir(os.path.join(tmp_path, "cache")) if name.endswith(".tmp")]
+    # The second run reads the token ids from the cache
+    assert run_generate(model_dir, tmp_path, "second.csv", *cache_argv) == expected